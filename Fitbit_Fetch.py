@@ -1,6 +1,11 @@
 # %%
-import base64, requests, schedule, time, json, pytz, logging, os, sys
-from requests.exceptions import ConnectionError
+import abc, base64, requests, schedule, time, json, pytz, logging, logging.handlers, contextvars, os, sys, tempfile, threading, zlib, gzip, hashlib, csv, io, re, zipfile, multiprocessing, calendar, queue, sqlite3, atexit, hmac, random, signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+from concurrent.futures import ProcessPoolExecutor, Future
+from array import array
+from collections import deque
+from requests.exceptions import ConnectionError, Timeout
 from datetime import datetime, timedelta
 # for influxdb 1.x
 from influxdb import InfluxDBClient
@@ -9,6 +14,13 @@ from influxdb.exceptions import InfluxDBClientError
 from influxdb_client import InfluxDBClient as InfluxDBClient2
 from influxdb_client.client.exceptions import InfluxDBError
 from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.domain.write_precision import WritePrecision
+from influxdb_client import BucketRetentionRules, TaskCreateRequest, TaskUpdateRequest
+# optional, only needed for the parquet archive
+try:
+    import pyarrow, pyarrow.compute, pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # %% [markdown]
 # ## Variables
@@ -16,7 +28,14 @@ from influxdb_client.client.write_api import SYNCHRONOUS
 # %%
 FITBIT_LOG_FILE_PATH = os.environ.get("FITBIT_LOG_FILE_PATH", "/app/logs/fitbit.log")
 TOKEN_FILE_PATH = os.environ.get("TOKEN_FILE_PATH", "/app/tokens/tokens.json")
-OVERWRITE_LOG_FILE = True
+STATE_FILE_PATH = os.environ.get("STATE_FILE_PATH", os.path.join(os.path.dirname(TOKEN_FILE_PATH), "state.json")) # Cursors and other state kept across restarts
+OVERWRITE_LOG_FILE = os.environ.get("OVERWRITE_LOG_FILE", "false").lower() == "true" # Start every run with a fresh log file, the previous one is kept as a rotated backup
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text") # text, or json for one structured record per line ( with job, endpoint and duration when known )
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024))) # Size based rotation of the log file
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN", "") # Time based rotation instead, e.g. midnight or H ( see TimedRotatingFileHandler )
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper() # DEBUG adds one record per Fitbit request, with its endpoint and duration
+LOG_RATE_LIMIT_PER_MINUTE = int(os.environ.get("LOG_RATE_LIMIT_PER_MINUTE", "0")) # Opt-in limit of INFO and below records per logging call site, 0 disables it
 FITBIT_LANGUAGE = os.environ.get("FITBIT_LANGUAGE", 'en_US')
 INFLUXDB_VERSION = os.environ.get("INFLUXDB_VERSION", "2")
 # Update these variables for influxdb 1.x versions
@@ -30,6 +49,25 @@ INFLUXDB_BUCKET = os.environ.get("INFLUXDB_BUCKET", "health_data")
 INFLUXDB_ORG = os.environ.get("INFLUXDB_ORG", "home")
 INFLUXDB_TOKEN = os.environ.get("INFLUXDB_TOKEN", "")
 INFLUXDB_URL = os.environ.get("INFLUXDB_URL", "http://influxdb:8086")
+# Optional columnar archive of every written point ( needs pyarrow ), leave empty to disable
+PARQUET_ARCHIVE_PATH = os.environ.get("PARQUET_ARCHIVE_PATH", "")
+# Server side downsampling ( InfluxDB 2.x tasks or 1.x continuous queries ) and raw data retention, see DOWNSAMPLING_RULES
+INFLUXDB_DOWNSAMPLING = os.environ.get("INFLUXDB_DOWNSAMPLING", "false").lower() == "true"
+INFLUXDB_ROLLUP_BUCKET = os.environ.get("INFLUXDB_ROLLUP_BUCKET", INFLUXDB_BUCKET + "_rollup") # 2.x bucket receiving the rollups
+INFLUXDB_ROLLUP_RETENTION_POLICY = os.environ.get("INFLUXDB_ROLLUP_RETENTION_POLICY", "fitbit_rollup") # 1.x retention policy receiving the rollups
+INFLUXDB_ROLLUP_RETENTION_DAYS = int(os.environ.get("INFLUXDB_ROLLUP_RETENTION_DAYS", "0")) # 0 keeps rollups forever
+# Comma separated output sinks, every point goes to all of them : influxdb, line_protocol_http, sqlite, parquet
+OUTPUT_SINKS = [sink.strip() for sink in os.environ.get("OUTPUT_SINKS", "influxdb").split(",") if sink.strip()]
+LINE_PROTOCOL_HTTP_URL = os.environ.get("LINE_PROTOCOL_HTTP_URL", "") # e.g. http://victoriametrics:8428/write or an InfluxDB 3 /api/v3/write_lp?db=fitbit url
+LINE_PROTOCOL_HTTP_TOKEN = os.environ.get("LINE_PROTOCOL_HTTP_TOKEN", "") # Sent as a Bearer token when set
+SQLITE_SINK_PATH = os.environ.get("SQLITE_SINK_PATH", "/app/logs/fitbit_points.sqlite")
+SINK_BATCH_SIZE = int(os.environ.get("SINK_BATCH_SIZE", "5000")) # Queued writes are merged up to this many points per request
+SINK_QUEUE_SIZE = int(os.environ.get("SINK_QUEUE_SIZE", "50")) # Writes buffered per sink before back-pressure kicks in
+SINK_ENQUEUE_TIMEOUT = int(os.environ.get("SINK_ENQUEUE_TIMEOUT", "120")) # Seconds to wait on a full sink queue before dropping the write for that sink
+SINK_WORKERS = int(os.environ.get("SINK_WORKERS", "1")) # Concurrent writer threads per sink
+SINK_WRITE_RETRIES = int(os.environ.get("SINK_WRITE_RETRIES", "3")) # Retries of a failed write before its points are spooled to disk
+SINK_SPOOL_PATH = os.environ.get("SINK_SPOOL_PATH", os.path.join(os.path.dirname(TOKEN_FILE_PATH), "spool")) # Writes a sink could not take wait here and are resent once it is back
+INFLUX_WRITE_BATCH_LINES = int(os.environ.get("INFLUX_WRITE_BATCH_LINES", "5000")) # Lines per write request to InfluxDB / line protocol receivers
 # MAKE SURE you set the application type to PERSONAL. Otherwise, you won't have access to intraday data series, resulting in 40X errors.
 client_id = os.environ.get("FITBIT_CLIENT_ID", "")
 client_secret = os.environ.get("FITBIT_CLIENT_SECRET", "")
@@ -42,88 +80,354 @@ SCHEDULE_AUTO_UPDATE = True if AUTO_DATE_RANGE else False # Scheduling updates o
 SERVER_ERROR_MAX_RETRY = 3
 EXPIRED_TOKEN_MAX_RETRY = 5
 SKIP_REQUEST_ON_SERVER_ERROR = True
+REQUEST_TIMEOUT_SECONDS = int(os.environ.get("REQUEST_TIMEOUT_SECONDS", "60")) # Connect / read timeout of a single http request
+REQUEST_DEADLINE_SECONDS = int(os.environ.get("REQUEST_DEADLINE_SECONDS", "900")) # Give up on a call after retrying this long ( rate limit waits excluded )
+RETRY_BACKOFF_BASE_SECONDS = int(os.environ.get("RETRY_BACKOFF_BASE_SECONDS", "5")) # Jittered exponential back-off between retries, doubled per failed attempt
+RETRY_BACKOFF_MAX_SECONDS = int(os.environ.get("RETRY_BACKOFF_MAX_SECONDS", "300"))
+CIRCUIT_BREAKER_THRESHOLD = int(os.environ.get("CIRCUIT_BREAKER_THRESHOLD", "5")) # Consecutive failures of an endpoint before it is skipped
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = int(os.environ.get("CIRCUIT_BREAKER_COOLDOWN_SECONDS", "3600")) # How long a tripped endpoint is skipped before it is tried again
+RAW_RESPONSE_ARCHIVE_PATH = os.environ.get("RAW_RESPONSE_ARCHIVE_PATH", "") # Keep a gzipped copy of every API response here, leave empty to disable
+# Serve every request from the archive instead of the API. Responses are found by exact url + params, so replay the date
+# range the archive was fetched with : a bulk replay asks for other ranges than the live runs did and misses those responses
+REPLAY_FROM_RAW_ARCHIVE = os.environ.get("REPLAY_FROM_RAW_ARCHIVE", "false").lower() == "true"
+TAKEOUT_IMPORT_PATH = os.environ.get("TAKEOUT_IMPORT_PATH", "") # Fitbit / Google Takeout export ( zip or extracted folder ) to import, then exit
+TAKEOUT_IMPORT_WORKERS = int(os.environ.get("TAKEOUT_IMPORT_WORKERS", str(os.cpu_count() or 1)))
+TAKEOUT_IMPORT_WINDOW = int(os.environ.get("TAKEOUT_IMPORT_WINDOW", str(4 * TAKEOUT_IMPORT_WORKERS))) # Files parsed ahead of the writer, bounds memory on big exports
+BULK_TRANSFORM_WORKERS = int(os.environ.get("BULK_TRANSFORM_WORKERS", str(os.cpu_count() or 1))) # Processes parsing fetched payloads in bulk mode, 1 parses in the main process
+BULK_PIPELINE_DEPTH = int(os.environ.get("BULK_PIPELINE_DEPTH", str(4 * BULK_TRANSFORM_WORKERS))) # Payloads fetched ahead of the writer before fetching waits
+SIMULATE_SCHEDULE = os.environ.get("SIMULATE_SCHEDULE", "false").lower() == "true" # Simulate a day of the job table against the rate limit, report and exit
+SIMULATE_SCHEDULE_HOURS = int(os.environ.get("SIMULATE_SCHEDULE_HOURS", "24"))
+SIMULATE_JOB_COSTS = os.environ.get("SIMULATE_JOB_COSTS", "") # Override estimated requests per run, e.g. ecg=3,food_logs=2
+JOB_INTERVALS = os.environ.get("JOB_INTERVALS", "") # Override job intervals in seconds, e.g. water_logs=10800,ecg=7200 ( live and simulated )
+FITBIT_RATE_LIMIT_PER_HOUR = 150
+OFFLINE_MODE = REPLAY_FROM_RAW_ARCHIVE or bool(TAKEOUT_IMPORT_PATH) or SIMULATE_SCHEDULE # No Fitbit API calls at all
+SCHEDULE_AUTO_UPDATE = SCHEDULE_AUTO_UPDATE and not OFFLINE_MODE
+# Writes an IngestionLatency measurement ( data freshness and watch sync to database lag ), live mode only
+INGESTION_LATENCY_TRACKING = os.environ.get("INGESTION_LATENCY_TRACKING", "true").lower() == "true" and AUTO_DATE_RANGE and not OFFLINE_MODE
+# Fitbit Subscriptions ( push notifications ). Serve this port behind an https reverse proxy and register the url as subscriber in dev.fitbit.com
+FITBIT_SUBSCRIBER_PORT = int(os.environ.get("FITBIT_SUBSCRIBER_PORT", "0")) # 0 disables the receiver
+FITBIT_SUBSCRIBER_VERIFICATION_CODE = os.environ.get("FITBIT_SUBSCRIBER_VERIFICATION_CODE", "")
+FITBIT_SUBSCRIBER_ID = os.environ.get("FITBIT_SUBSCRIBER_ID", "fitbit-fetch")
+FITBIT_SUBSCRIPTION_COLLECTIONS = [collection.strip() for collection in os.environ.get("FITBIT_SUBSCRIPTION_COLLECTIONS", "activities,body,foods,sleep").split(",") if collection.strip()]
+FITBIT_SUBSCRIPTION_SAFETY_POLL_SECONDS = int(os.environ.get("FITBIT_SUBSCRIPTION_SAFETY_POLL_SECONDS", str(12 * 3600))) # With the receiver on, subscribed collections are only polled this often, in case a notification got lost
+# Local read only JSON api with the latest value and a short window of every measurement, for dashboards and home automation
+LATEST_VALUE_API_PORT = int(os.environ.get("LATEST_VALUE_API_PORT", "0")) # 0 disables the api. No authentication, don't publish it outside your network
+LATEST_VALUE_WINDOW_SECONDS = int(os.environ.get("LATEST_VALUE_WINDOW_SECONDS", "3600")) # Window kept per series, counted back from its newest point
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS", "600")) # Refresh the access token this many seconds before it expires
+ECG_BACKFILL_START_DATE = os.environ.get("ECG_BACKFILL_START_DATE", "") # YYYY-MM-DD, first run only. Defaults to the working start date
+ACTIVITIES_BACKFILL_START_DATE = os.environ.get("ACTIVITIES_BACKFILL_START_DATE", "") # YYYY-MM-DD, first run walks the activity log back to here. Defaults to the working start date
+ACTIVITIES_OVERLAP_DAYS = int(os.environ.get("ACTIVITIES_OVERLAP_DAYS", "3")) # Every run re-reads this many days before the cursor, for late synced and back-dated activities
+ECG_WAVEFORM_PATH = os.environ.get("ECG_WAVEFORM_PATH", "/app/ecg") # Compressed ECG waveform files are stored here, set empty to skip waveforms
+INTRADAY_RESOURCES = [resource.strip() for resource in os.environ.get("INTRADAY_RESOURCES", "heart,steps").split(",") if resource.strip()] # Names from INTRADAY_RESOURCE_CATALOG
+INTRADAY_HOURLY_REQUEST_BUDGET = int(os.environ.get("INTRADAY_HOURLY_REQUEST_BUDGET", "40")) # Share of the 150 requests/hour spent on today's intraday data
+LIST_BACKFILL_MAX_PAGES = int(os.environ.get("LIST_BACKFILL_MAX_PAGES", "10")) # Max pages fetched per run from paginated list endpoints, backfill continues next run
 
 # %% [markdown]
 # ## Logging setup
 
+# Callers only put records on a queue, a background listener thread formats them and does the file / console I/O.
+# Rotation replaces truncating the log file, chatty call sites can be rate limited before anything is queued.
+
 # %%
-if OVERWRITE_LOG_FILE:
-    with open(FITBIT_LOG_FILE_PATH, "w"): pass
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(FITBIT_LOG_FILE_PATH, mode='a'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+current_job = contextvars.ContextVar("current_job", default=None) # Set by run_job, attached to every record logged inside a job
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        for key in ("job", "endpoint", "duration"):
+            if getattr(record, key, None) is not None:
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class LogContextFilter(logging.Filter):
+    """Adds the running job to the record and, when LOG_RATE_LIMIT_PER_MINUTE is set, rate limits INFO and below per call site.
+    Every call site that dropped records gets one WARNING summary through report_suppressed once its minute is over"""
+    def __init__(self, report_suppressed):
+        super().__init__()
+        self.report_suppressed = report_suppressed
+        self.call_sites = {} # ( path, line ) -> [ window start, records in window, suppressed, first message ]
+        self.call_sites_lock = threading.Lock()
+        self.next_window_check = 0
+
+    def filter(self, record):
+        if not hasattr(record, "job"):
+            record.job = current_job.get()
+        if LOG_RATE_LIMIT_PER_MINUTE <= 0:
+            return True
+        allowed = True
+        with self.call_sites_lock:
+            ended_windows = self.end_windows(record.created) if record.created >= self.next_window_check else []
+            if record.levelno < logging.WARNING:
+                call_site = self.call_sites.setdefault((record.pathname, record.lineno), [record.created, 0, 0, record.msg])
+                call_site[1] += 1
+                if call_site[1] > LOG_RATE_LIMIT_PER_MINUTE:
+                    call_site[2] += 1
+                    allowed = False
+        for summary in ended_windows:
+            self.report_suppressed(summary)
+        return allowed
+
+    def end_windows(self, now, everything=False):
+        """Drops the call site windows older than a minute ( or all of them ), returns summaries of the ones that suppressed records"""
+        self.next_window_check = now + 1
+        summaries = []
+        for (path, line), call_site in list(self.call_sites.items()):
+            if everything or now - call_site[0] >= 60:
+                del self.call_sites[(path, line)]
+                if call_site[2]:
+                    summaries.append(logging.LogRecord("root", logging.WARNING, path, line, f"{call_site[2]} similar messages suppressed at {os.path.basename(path)}:{line} since {time.strftime('%H:%M:%S', time.localtime(call_site[0]))}, first one : {call_site[3]}", None, None))
+        return summaries
+
+    def flush(self):
+        with self.call_sites_lock:
+            ended_windows = self.end_windows(time.time(), everything=True)
+        for summary in ended_windows:
+            self.report_suppressed(summary)
+
+def log_formatter():
+    return JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+if LOG_ROTATE_WHEN:
+    log_file_handler = logging.handlers.TimedRotatingFileHandler(FITBIT_LOG_FILE_PATH, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+else:
+    log_file_handler = logging.handlers.RotatingFileHandler(FITBIT_LOG_FILE_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+if OVERWRITE_LOG_FILE and os.path.getsize(FITBIT_LOG_FILE_PATH) > 0:
+    log_file_handler.doRollover()
+log_output_handlers = [log_file_handler, logging.StreamHandler(sys.stdout)]
+for handler in log_output_handlers:
+    handler.setFormatter(log_formatter())
+
+log_queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+log_queue_handler.setFormatter(logging.Formatter("%(message)s")) # Only merges args into the message, the output handlers do the real formatting
+log_context_filter = LogContextFilter(lambda summary : log_queue_handler.enqueue(log_queue_handler.prepare(summary))) # Summaries skip the filter itself
+log_queue_handler.addFilter(log_context_filter)
+log_listener = logging.handlers.QueueListener(log_queue_handler.queue, *log_output_handlers)
+log_listener.start()
+atexit.register(log_listener.stop) # Registered first so it runs last and still drains the other exit handlers' records
+atexit.register(log_context_filter.flush) # Summaries of windows still open at exit
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_queue_handler])
+
+def direct_worker_logging():
+    """Worker process initializer : forked workers have no listener thread, they log straight to the console"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(log_formatter())
+    logging.getLogger().handlers = [handler]
+
+def fork_worker_pool(max_workers):
+    """Process pool forked while the other threads are quiet. fork keeps the configured globals ( timezone, device name,
+    intraday catalog ) in the workers without re-running this script, but it also copies every lock as it is at that
+    moment : the sinks are flushed so their writers sit idle and the log listener, the only thread writing to the console,
+    is stopped until every worker exists"""
+    flush_output_sinks()
+    log_listener.stop() # records logged meanwhile wait in the queue
+    try:
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork"), initializer=direct_worker_logging)
+        executor.submit(int).result() # With fork all workers start on the first submit, not later on demand
+    finally:
+        log_listener.start()
+    return executor
+
+# %% [markdown]
+# ## Raw response archive ( optional )
+
+# %%
+# Archive files are content addressed by url + params, so a later fetch of the same request replaces the older copy
+def raw_archive_file_path(url, params):
+    request_key = hashlib.sha256(json.dumps([url, params], sort_keys=True).encode()).hexdigest()
+    return os.path.join(RAW_RESPONSE_ARCHIVE_PATH, request_key[:2], request_key + ".json.gz")
+
+def save_raw_response(url, params, json_data):
+    file_path = raw_archive_file_path(url, params)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = file_path + ".tmp"
+    with gzip.open(temp_path, "wt") as file:
+        json.dump({"url": url, "params": params, "fetched_at": datetime.now(pytz.utc).isoformat(), "response": json_data}, file)
+    os.replace(temp_path, file_path)
+
+replay_counts = {"requests": 0, "misses": 0}
+replay_counts_lock = threading.Lock()
+
+def load_raw_response(url, params):
+    with replay_counts_lock:
+        replay_counts["requests"] += 1
+    try:
+        with gzip.open(raw_archive_file_path(url, params), "rt") as file:
+            return json.load(file)["response"]
+    except FileNotFoundError:
+        with replay_counts_lock:
+            replay_counts["misses"] += 1
+        logging.warning("Replay : no archived response for " + url + " " + str(params) + ", skipping")
+        return None
+    except (OSError, EOFError, ValueError, KeyError) as err: # Truncated or corrupted archive file, the rest of the replay goes on
+        logging.error("Replay : unreadable archived response for " + url + " " + str(params) + ", skipping : " + str(err))
+        return None
+
+def report_replay_misses():
+    if replay_counts["misses"]:
+        logging.warning(f"Replay : {replay_counts['misses']} of {replay_counts['requests']} requests had no archived response, replay the date range the archive was fetched with")
+    else:
+        logging.info(f"Replay : all {replay_counts['requests']} requests served from the archive")
+
+if REPLAY_FROM_RAW_ARCHIVE:
+    atexit.register(report_replay_misses)
 
 # %% [markdown]
 # ## Setting up base API Caller function
 
 # %%
 # Generic Request caller for all
+def endpoint_key(url):
+    """Url with dates and ids replaced by placeholders, so every day of the same endpoint shares one circuit breaker"""
+    path = urlparse(url).path
+    path = re.sub(r"\d{4}-\d{2}-\d{2}", "{date}", path)
+    return re.sub(r"/\d{3,}(?=[/.]|$)", "/{id}", path) # Log ids, the short api version prefix is kept
+
+circuit_breakers = {} # endpoint key -> {"failures": consecutive failures, "open_until": epoch seconds, "probe_until": epoch seconds}
+circuit_breakers_lock = threading.Lock()
+
+def circuit_is_open(endpoint):
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(endpoint)
+        return breaker is not None and time.time() < breaker["open_until"]
+
+def circuit_allows_request(endpoint):
+    """False while the breaker is open. Once the cool-down is over ( half open ) exactly one caller gets True and probes,
+    the others keep skipping until the probe's success closes the breaker or its failure opens it again"""
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(endpoint)
+        now = time.time()
+        if breaker is None or breaker["failures"] < CIRCUIT_BREAKER_THRESHOLD:
+            return True
+        if now < breaker["open_until"] or now < breaker["probe_until"]:
+            return False
+        breaker["probe_until"] = now + REQUEST_DEADLINE_SECONDS # Lets a new probe through if this one ends without a verdict
+        return True
+
+def record_endpoint_success(endpoint):
+    with circuit_breakers_lock:
+        circuit_breakers.pop(endpoint, None)
+
+def record_endpoint_failure(endpoint):
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.setdefault(endpoint, {"failures": 0, "open_until": 0, "probe_until": 0})
+        breaker["failures"] += 1
+        if breaker["failures"] >= CIRCUIT_BREAKER_THRESHOLD: # Stays tripped after the cool-down until a call succeeds, one failed probe re-opens it
+            breaker["open_until"] = time.time() + CIRCUIT_BREAKER_COOLDOWN_SECONDS
+            breaker["probe_until"] = 0
+            logging.warning(f"Circuit breaker open for {endpoint} after {breaker['failures']} consecutive failures, skipping it for {CIRCUIT_BREAKER_COOLDOWN_SECONDS} seconds")
+
+def backoff_seconds(failed_attempts):
+    """Exponential back-off with jitter, half fixed and half random so concurrent callers spread out"""
+    ceiling = min(RETRY_BACKOFF_MAX_SECONDS, RETRY_BACKOFF_BASE_SECONDS * 2 ** max(failed_attempts - 1, 0))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
 def request_data_from_fitbit(url, headers={}, params={}, data={}, request_type="get"):
-    global ACCESS_TOKEN
+    """Web API call with the current access token, or a call with its own headers ( the token endpoint )"""
     retry_attempts = 0
+    failed_attempts = 0
+    uses_access_token = not headers
     logging.debug("Requesting data from fitbit via Url : " + url)
-    while True: # Unlimited Retry attempts
-        if request_type == "get":
+    if REPLAY_FROM_RAW_ARCHIVE and request_type == "get":
+        return load_raw_response(url, params)
+    endpoint = endpoint_key(url)
+    if request_type == "get" and not circuit_allows_request(endpoint):
+        logging.debug("Circuit breaker open, skipping request -> " + url)
+        return None
+    deadline = time.time() + REQUEST_DEADLINE_SECONDS
+    while True: # Retries until the deadline
+        if uses_access_token:
+            used_token = ACCESS_TOKEN
             headers = {
-                "Authorization": f"Bearer {ACCESS_TOKEN}",
+                "Authorization": f"Bearer {used_token}",
                 "Accept": "application/json",
                 'Accept-Language': FITBIT_LANGUAGE
             }
         try:
+            request_started = time.time()
             if request_type == "get":
-                response = requests.get(url, headers=headers, params=params, data=data)
+                response = requests.get(url, headers=headers, params=params, data=data, timeout=REQUEST_TIMEOUT_SECONDS)
             elif request_type == "post":
-                response = requests.post(url, headers=headers, params=params, data=data)
+                response = requests.post(url, headers=headers, params=params, data=data, timeout=REQUEST_TIMEOUT_SECONDS)
             else:
                 raise Exception("Invalid request type " + str(request_type))
-
-            if response.status_code == 200: # Success
-                return response.json()
+            logging.debug(f"Fitbit API answered {response.status_code} for {endpoint}", extra={"endpoint": endpoint, "duration": round(time.time() - request_started, 3)})
+
+            if response.status_code in (200, 201): # Success, 201 when a POST created something
+                json_data = response.json()
+                record_endpoint_success(endpoint)
+                if RAW_RESPONSE_ARCHIVE_PATH and request_type == "get":
+                    save_raw_response(url, params, json_data)
+                return json_data
             elif response.status_code == 429: # API Limit reached
                 retry_after = int(response.headers["Fitbit-Rate-Limit-Reset"]) + 300 # Fitbit changed their headers.
                 logging.warning("Fitbit API limit reached. Error code : " + str(response.status_code) + ", Retrying in " + str(retry_after) + " seconds")
-                print("Fitbit API limit reached. Error code : " + str(response.status_code) + ", Retrying in " + str(retry_after) + " seconds")
                 time.sleep(retry_after)
-            elif response.status_code == 401: # Access token expired ( most likely )
-                logging.info("Current Access Token : " + ACCESS_TOKEN)
+                deadline += retry_after # The quota is account wide, waiting on it says nothing about this endpoint
+                continue
+            elif response.status_code == 401 and uses_access_token: # Access token expired ( most likely )
                 logging.warning("Error code : " + str(response.status_code) + ", Details : " + response.text)
-                print("Error code : " + str(response.status_code) + ", Details : " + response.text)
-                ACCESS_TOKEN = Get_New_Access_Token(client_id, client_secret)
-                logging.info("New Access Token : " + ACCESS_TOKEN)
-                time.sleep(30)
                 if retry_attempts > EXPIRED_TOKEN_MAX_RETRY:
                     logging.error("Unable to solve the 401 Error. Please debug - " + response.text)
                     raise Exception("Unable to solve the 401 Error. Please debug - " + response.text)
+                # Only refreshes if no other caller has replaced the rejected token in the meantime
+                Get_New_Access_Token(client_id, client_secret, rejected_token=used_token)
+                retry_attempts += 1
+                continue # Retry straight away with the new token
+            elif response.status_code == 401: # Token endpoint rejected the refresh token, retrying won't help
+                logging.error("Fitbit rejected the refresh token. Please debug - " + response.text)
+                raise Exception("Fitbit rejected the refresh token. Please debug - " + response.text)
             elif response.status_code in [500, 502, 503, 504]: # Fitbit server is down or not responding ( most likely ):
-                logging.warning("Server Error encountered ( Code 5xx ): Retrying after 120 seconds....")
-                time.sleep(120)
-                if retry_attempts > SERVER_ERROR_MAX_RETRY:
+                record_endpoint_failure(endpoint)
+                failed_attempts += 1
+                if failed_attempts > SERVER_ERROR_MAX_RETRY or (request_type == "get" and circuit_is_open(endpoint)):
                     logging.error("Unable to solve the server Error. Retry limit exceed. Please debug - " + response.text)
                     if SKIP_REQUEST_ON_SERVER_ERROR:
                         logging.warning("Retry limit reached for server error : Skipping request -> " + url)
                         return None
+                logging.warning(f"Server Error encountered ( Code {response.status_code} ) on {endpoint}, attempt {failed_attempts}")
             else:
+                record_endpoint_failure(endpoint) # e.g. endpoints the device does not support, the breaker stops asking every run
                 logging.error("Fitbit API request failed. Status code: " + str(response.status_code) + " " + str(response.text) )
-                print(f"Fitbit API request failed. Status code: {response.status_code}", response.text)
                 response.raise_for_status()
                 return None
 
-        except ConnectionError as e:
-            logging.error("Retrying in 5 minutes - Failed to connect to internet : " + str(e))
-            print("Retrying in 5 minutes - Failed to connect to internet : " + str(e))
-        retry_attempts += 1
-        time.sleep(30)
+        except ConnectionError as e: # No connection at all is not the endpoint's fault, only back off
+            failed_attempts += 1
+            logging.error(f"Failed to connect to internet, attempt {failed_attempts} : " + str(e))
+        except Timeout as e: # Connected but the endpoint did not answer in time
+            record_endpoint_failure(endpoint)
+            failed_attempts += 1
+            logging.error(f"Request to {endpoint} timed out, attempt {failed_attempts} : " + str(e))
+            if request_type == "get" and circuit_is_open(endpoint):
+                return None
+        wait_seconds = backoff_seconds(failed_attempts)
+        if time.time() + wait_seconds > deadline:
+            logging.error(f"Giving up on {url} after {failed_attempts} failed attempts, request deadline of {REQUEST_DEADLINE_SECONDS} seconds reached")
+            if request_type == "get" and SKIP_REQUEST_ON_SERVER_ERROR:
+                return None
+            raise Exception("Request deadline reached for " + url)
+        time.sleep(wait_seconds)
 
 # %% [markdown]
 # ## Token Refresh Management
 
 # %%
+def write_json_atomically(file_path, content):
+    """Writes json to a temp file next to file_path and swaps it in, so readers never see a half written file"""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(file_descriptor, "w") as file:
+            json.dump(content, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
 def refresh_fitbit_tokens(client_id, client_secret, refresh_token):
     logging.info("Attempting to refresh tokens...")
     url = "https://api.fitbit.com/oauth2/token"
@@ -138,77 +442,942 @@ def refresh_fitbit_tokens(client_id, client_secret, refresh_token):
     json_data = request_data_from_fitbit(url, headers=headers, data=data, request_type="post")
     access_token = json_data["access_token"]
     new_refresh_token = json_data["refresh_token"]
+    expires_at = time.time() + int(json_data.get("expires_in", 28800)) # Fitbit access tokens live 8 hours by default
     tokens = {
         "access_token": access_token,
-        "refresh_token": new_refresh_token
+        "refresh_token": new_refresh_token,
+        "expires_at": expires_at
     }
-    with open(TOKEN_FILE_PATH, "w") as file:
-        json.dump(tokens, file)
-    logging.info("Fitbit token refresh successful!")
-    return access_token, new_refresh_token
+    write_json_atomically(TOKEN_FILE_PATH, tokens)
+    logging.info("Fitbit token refresh successful! Access token valid until " + datetime.fromtimestamp(expires_at).isoformat())
+    return access_token, new_refresh_token, expires_at
 
 def load_tokens_from_file():
     with open(TOKEN_FILE_PATH, "r") as file:
         tokens = json.load(file)
-        return tokens.get("access_token"), tokens.get("refresh_token")
+        return tokens.get("access_token"), tokens.get("refresh_token"), tokens.get("expires_at", 0)
+
+ACCESS_TOKEN_EXPIRES_AT = 0
+token_refresh_lock = threading.Lock() # Single flight : only one refresh runs at a time, the rest wait and reuse its result
+
+def Get_New_Access_Token(client_id, client_secret, rejected_token=None):
+    """Returns a valid access token, refreshing it only when it is close to expiry or was rejected by the API"""
+    global ACCESS_TOKEN, ACCESS_TOKEN_EXPIRES_AT
+    with token_refresh_lock:
+        if rejected_token is not None and rejected_token != ACCESS_TOKEN:
+            return ACCESS_TOKEN # Another caller already refreshed while we were waiting
+        try:
+            access_token, refresh_token, expires_at = load_tokens_from_file()
+        except FileNotFoundError:
+            access_token, expires_at = None, 0
+            refresh_token = input("No token file found. Please enter a valid refresh token : ")
+        if rejected_token is None and access_token and time.time() < expires_at - TOKEN_REFRESH_MARGIN_SECONDS:
+            ACCESS_TOKEN, ACCESS_TOKEN_EXPIRES_AT = access_token, expires_at # Stored token is still good, no refresh needed
+        else:
+            ACCESS_TOKEN, refresh_token, ACCESS_TOKEN_EXPIRES_AT = refresh_fitbit_tokens(client_id, client_secret, refresh_token)
+        return ACCESS_TOKEN
+
+def keep_access_token_fresh():
+    """Background loop refreshing the access token shortly before it expires, so requests never wait on auth"""
+    while True:
+        seconds_to_refresh = ACCESS_TOKEN_EXPIRES_AT - TOKEN_REFRESH_MARGIN_SECONDS - time.time()
+        if seconds_to_refresh > 0:
+            time.sleep(min(seconds_to_refresh, 300))
+            continue
+        try:
+            Get_New_Access_Token(client_id, client_secret)
+        except Exception as e:
+            logging.error("Background token refresh failed, retrying in 60 seconds : " + str(e))
+            time.sleep(60)
+
+if not OFFLINE_MODE: # Replay and Takeout import never talk to the API
+    ACCESS_TOKEN = Get_New_Access_Token(client_id, client_secret)
+    threading.Thread(target=keep_access_token_fresh, name="token-refresh", daemon=True).start()
 
-def Get_New_Access_Token(client_id, client_secret):
+# %% [markdown]
+# ## Persisted state ( cursors )
+
+# %%
+def load_state():
     try:
-        access_token, refresh_token = load_tokens_from_file()
+        with open(STATE_FILE_PATH, "r") as file:
+            return json.load(file)
     except FileNotFoundError:
-        refresh_token = input("No token file found. Please enter a valid refresh token : ")
-    access_token, refresh_token = refresh_fitbit_tokens(client_id, client_secret, refresh_token)
-    return access_token
+        return {}
+    except ValueError as err:
+        logging.error("State file is corrupted, starting with empty state : " + str(err))
+        return {}
+
+persisted_state = load_state()
+
+# Replay, Takeout import and the simulator keep state in memory only, the live state file belongs to the scheduled run
+def save_state(key, value):
+    persisted_state[key] = value
+    if not OFFLINE_MODE:
+        write_json_atomically(STATE_FILE_PATH, persisted_state)
+
+# Cursors that must not move past points still in collected_records, saved by commit_pending_state after the write
+pending_state = {}
+
+def save_state_after_write(key, value):
+    pending_state[key] = value
+
+def current_state(key):
+    """Value including a pending update, for readers that run before the commit"""
+    return pending_state.get(key, persisted_state.get(key))
 
-ACCESS_TOKEN = Get_New_Access_Token(client_id, client_secret)
+def commit_pending_state():
+    if pending_state:
+        persisted_state.update(pending_state)
+        if not OFFLINE_MODE:
+            write_json_atomically(STATE_FILE_PATH, persisted_state)
+        pending_state.clear()
 
 # %% [markdown]
-# ## Influxdb Database Initialization
+# ## Compact point batches
+# High volume intraday series share measurement, tags and field name, so they are kept as two flat arrays
+# ( UTC epoch seconds and values ) instead of one dict per sample. The writer turns them into line protocol directly.
 
 # %%
-if INFLUXDB_VERSION == "2":
-    try:
-        influxdbclient = InfluxDBClient2(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
-        influxdb_write_api = influxdbclient.write_api(write_options=SYNCHRONOUS)
-    except InfluxDBError as err:
-        logging.error("Unable to connect with influxdb 2.x database! Aborted")
-        raise InfluxDBError("InfluxDB connection failed:" + str(err))
-elif INFLUXDB_VERSION == "1":
-    try:
-        influxdbclient = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD)
-        influxdbclient.switch_database(INFLUXDB_DATABASE)
-    except InfluxDBClientError as err:
-        logging.error("Unable to connect with influxdb 1.x database! Aborted")
-        raise InfluxDBClientError("InfluxDB connection failed:" + str(err))
-else:
-    logging.error("No matching version found. Supported values are 1 and 2")
-    raise InfluxDBClientError("No matching version found. Supported values are 1 and 2:")
+def escape_line_protocol(text, escape_equals=True):
+    text = str(text).replace(",", "\\,").replace(" ", "\\ ")
+    return text.replace("=", "\\=") if escape_equals else text
+
+class PointBatch:
+    __slots__ = ("measurement", "tags", "field", "times", "values")
+
+    def __init__(self, measurement, tags, field="value", value_typecode="d"):
+        self.measurement = measurement
+        self.tags = tags
+        self.field = field
+        self.times = array('q') # UTC epoch seconds
+        self.values = array(value_typecode) # 'q' is written as an influxdb integer field, 'd' as float
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, epoch_seconds, value):
+        self.times.append(epoch_seconds)
+        self.values.append(value)
+
+    def to_dicts(self):
+        """Expands the batch to regular point dicts, for consumers that need them"""
+        for epoch_seconds, value in zip(self.times, self.values):
+            yield {
+                "measurement": self.measurement,
+                "time": datetime.fromtimestamp(epoch_seconds, pytz.utc).isoformat(),
+                "tags": dict(self.tags),
+                "fields": {self.field: value}
+            }
 
-def write_points_to_influxdb(points):
-    if INFLUXDB_VERSION == "2":
+def local_time_to_utc_iso(naive_time):
+    return LOCAL_TIMEZONE.localize(naive_time).astimezone(pytz.utc).isoformat()
+
+# Local "YYYY-MM-DDTHH:MM:SS" to UTC epoch seconds, localizing once per hour instead of once per sample
+def local_time_to_epoch_seconds(local_time_str, hour_start_cache):
+    hour_key = local_time_str[:13]
+    if hour_key not in hour_start_cache:
+        hour_start_cache[hour_key] = int(LOCAL_TIMEZONE.localize(datetime.fromisoformat(hour_key + ":00:00")).timestamp())
+    return hour_start_cache[hour_key] + int(local_time_str[14:16]) * 60 + int(local_time_str[17:19])
+
+# %% [markdown]
+# ## Output sinks ( InfluxDB and others )
+# Every sink owns a bounded queue and worker threads, so a slow or broken sink only holds back its own writes.
+# Queued writes are merged into bigger batches, and writes use compression where the target supports it.
+# Failed writes are retried, then spooled to disk and resent later, so cursors and job state can move on without losing points.
+
+# %%
+def point_count(points):
+    return sum(len(point) if isinstance(point, PointBatch) else 1 for point in points)
+
+def format_line_protocol_field(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value) + "i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def line_protocol_series_key(measurement, tags):
+    return escape_line_protocol(measurement, escape_equals=False) + "".join("," + escape_line_protocol(key) + "=" + escape_line_protocol(value) for key, value in sorted(tags.items()) if value is not None and value != "")
+
+# Shaped for the storage engine : lines grouped by series, sorted by time within each series, second timestamps,
+# and the fields of one series and second merged into a single line ( e.g. the four Activity Minutes points of a day ).
+# Sub-second precision is dropped : points of one series within the same second collapse into one line, and when they
+# share a field the last one wins. Fitbit data has at most second resolution. See tests/bench_write_shaping.py
+def points_to_line_protocol(points):
+    series_sources = {} # series key -> point batches and ( epoch seconds, fields ) of point dicts
+    for point in points:
+        if isinstance(point, PointBatch):
+            if len(point):
+                series_sources.setdefault(line_protocol_series_key(point.measurement, point.tags), []).append(point)
+        else:
+            fields = {escape_line_protocol(key): format_line_protocol_field(value) for key, value in point["fields"].items() if value is not None}
+            if fields:
+                series_sources.setdefault(line_protocol_series_key(point["measurement"], point.get("tags", {})), []).append((int(datetime.fromisoformat(point["time"]).timestamp()), fields))
+    lines = []
+    for series_key in sorted(series_sources):
+        sources = series_sources[series_key]
+        if all(isinstance(source, PointBatch) and (source.field, source.values.typecode) == (sources[0].field, sources[0].values.typecode) for source in sources):
+            # Common case, batches of one field ( e.g. one per day ) : no merging needed when each is ordered and they don't overlap
+            sources = sorted(sources, key=lambda batch : batch.times[0])
+            if all(earlier < later for batch in sources for earlier, later in zip(batch.times, batch.times[1:])) and all(earlier.times[-1] < later.times[0] for earlier, later in zip(sources, sources[1:])):
+                prefix = series_key + " " + escape_line_protocol(sources[0].field) + "="
+                value_suffix = "i " if sources[0].values.typecode == 'q' else " "
+                for batch in sources:
+                    lines.extend(prefix + repr(value) + value_suffix + str(epoch_seconds) for epoch_seconds, value in zip(batch.times, batch.values))
+                continue
+        merged = {} # epoch seconds -> {escaped field key: formatted value}, later points win like they would in the database
+        for source in sources:
+            if isinstance(source, PointBatch):
+                field_key = escape_line_protocol(source.field)
+                integer_suffix = "i" if source.values.typecode == 'q' else ""
+                for epoch_seconds, value in zip(source.times, source.values):
+                    merged.setdefault(epoch_seconds, {})[field_key] = repr(value) + integer_suffix
+            else:
+                merged.setdefault(source[0], {}).update(source[1])
+        lines.extend(series_key + " " + ",".join(key + "=" + value for key, value in merged[epoch_seconds].items()) + " " + str(epoch_seconds) for epoch_seconds in sorted(merged))
+    return lines
+
+def line_protocol_batches(lines, batch_lines=INFLUX_WRITE_BATCH_LINES):
+    return [lines[start:start + batch_lines] for start in range(0, len(lines), batch_lines)]
+
+def points_to_spool_entries(points):
+    for point in points:
+        if isinstance(point, PointBatch):
+            yield {"measurement": point.measurement, "tags": point.tags, "field": point.field, "typecode": point.values.typecode, "times": point.times.tolist(), "values": point.values.tolist()}
+        else:
+            yield point
+
+def spool_entries_to_points(entries):
+    points = []
+    for entry in entries:
+        if "times" in entry:
+            batch = PointBatch(entry["measurement"], entry["tags"], entry["field"], entry["typecode"])
+            batch.times.extend(entry["times"])
+            batch.values.extend(entry["values"])
+            points.append(batch)
+        else:
+            points.append(entry)
+    return points
+
+class OutputSink(abc.ABC):
+    name = "sink"
+
+    def __init__(self, batch_size=SINK_BATCH_SIZE, queue_size=SINK_QUEUE_SIZE, workers=SINK_WORKERS):
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.spool_lock = threading.Lock()
+        for worker_number in range(workers):
+            threading.Thread(target=self.drain_queue, name=self.name + "-writer-" + str(worker_number), daemon=True).start()
+
+    @abc.abstractmethod
+    def write(self, points):
+        """Writes the points synchronously, raises when the target did not take them"""
+
+    def submit(self, points):
+        try:
+            self.queue.put(points, timeout=SINK_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            logging.error("Output sink " + self.name + " is not keeping up, spooling " + str(point_count(points)) + " points")
+            self.spool_or_drop(points)
+
+    def spool_directory(self):
+        return os.path.join(SINK_SPOOL_PATH, self.name)
+
+    def spool(self, points):
+        directory = self.spool_directory()
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, f"{time.time_ns()}-{threading.get_ident()}.json.gz") # Name order is write order
+        with gzip.open(file_path + ".tmp", "wt") as file:
+            json.dump(list(points_to_spool_entries(points)), file, default=str)
+        os.replace(file_path + ".tmp", file_path)
+        logging.warning(f"Spooled {point_count(points)} points for output sink {self.name} to {file_path}")
+
+    def spool_or_drop(self, points):
         try:
-            influxdb_write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=points)
-            logging.info("Successfully updated influxdb database with new points")
+            self.spool(points)
+        except Exception as err:
+            logging.error(f"Spooling to {self.spool_directory()} failed, dropped {point_count(points)} points for output sink {self.name}! {err}")
+
+    def write_with_retries(self, points):
+        for attempt in range(1, SINK_WRITE_RETRIES + 2):
+            try:
+                self.write(points)
+                return True
+            except Exception as err:
+                logging.error(f"Writing to output sink {self.name} failed, attempt {attempt} : {err}")
+                if attempt <= SINK_WRITE_RETRIES:
+                    time.sleep(backoff_seconds(attempt))
+        return False
+
+    def resend_spooled(self):
+        """Writes spooled points oldest first, stopping at the first failure so the rest waits for the next try"""
+        if not self.spool_lock.acquire(blocking=False): # Another writer thread is already on it
+            return
+        try:
+            directory = self.spool_directory()
+            spooled_files = sorted(file_name for file_name in os.listdir(directory) if file_name.endswith(".json.gz")) if os.path.isdir(directory) else []
+            for position, file_name in enumerate(spooled_files):
+                file_path = os.path.join(directory, file_name)
+                try:
+                    with gzip.open(file_path, "rt") as file:
+                        points = spool_entries_to_points(json.load(file))
+                except (OSError, EOFError, ValueError, KeyError) as err:
+                    logging.error(f"Unreadable spool file {file_path}, moved aside : {err}")
+                    os.replace(file_path, file_path + ".corrupt")
+                    continue
+                try:
+                    self.write(points)
+                except Exception as err:
+                    logging.warning(f"Output sink {self.name} still failing, {len(spooled_files) - position} spooled writes kept for later : {err}")
+                    return
+                os.remove(file_path)
+                logging.info(f"Resent {point_count(points)} spooled points to {self.name}")
+        finally:
+            self.spool_lock.release()
+
+    def drain_queue(self):
+        self.resend_spooled() # Leftovers of earlier runs
+        while True:
+            points = list(self.queue.get())
+            merged_writes = 1
+            while point_count(points) < self.batch_size: # merge whatever else is already waiting
+                try:
+                    points.extend(self.queue.get_nowait())
+                    merged_writes += 1
+                except queue.Empty:
+                    break
+            try:
+                if self.write_with_retries(points):
+                    logging.info("Successfully wrote " + str(point_count(points)) + " points to " + self.name)
+                    self.resend_spooled()
+                else:
+                    self.spool_or_drop(points)
+            finally:
+                for _ in range(merged_writes):
+                    self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+class InfluxDB2Sink(OutputSink):
+    name = "influxdb2"
+
+    def __init__(self):
+        try:
+            self.client = InfluxDBClient2(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG, enable_gzip=True)
+            self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
         except InfluxDBError as err:
-            logging.error("Unable to connect with influxdb 2.x database! " + str(err))
-            print("Influxdb connection failed! ", str(err))
-    elif INFLUXDB_VERSION == "1":
+            logging.error("Unable to connect with influxdb 2.x database! Aborted")
+            raise InfluxDBError("InfluxDB connection failed:" + str(err))
+        super().__init__()
+
+    def write(self, points):
+        for batch in line_protocol_batches(points_to_line_protocol(points)):
+            self.write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=batch, write_precision=WritePrecision.S)
+
+class InfluxDB1Sink(OutputSink):
+    name = "influxdb1"
+
+    def __init__(self):
         try:
-            influxdbclient.write_points(points)
-            logging.info("Successfully updated influxdb database with new points")
+            self.client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD, gzip=True)
+            self.client.switch_database(INFLUXDB_DATABASE)
         except InfluxDBClientError as err:
-            logging.error("Unable to connect with influxdb 1.x database! " + str(err))
-            print("Influxdb connection failed! ", str(err))
-    else:
+            logging.error("Unable to connect with influxdb 1.x database! Aborted")
+            raise InfluxDBClientError("InfluxDB connection failed:" + str(err))
+        super().__init__()
+
+    def write(self, points):
+        for batch in line_protocol_batches(points_to_line_protocol(points)):
+            self.client.write_points(batch, time_precision='s', database=INFLUXDB_DATABASE, protocol='line')
+
+# Any target accepting influx line protocol over HTTP ( VictoriaMetrics, InfluxDB 3, Telegraf http listener ... )
+class LineProtocolHTTPSink(OutputSink):
+    name = "line_protocol_http"
+
+    def __init__(self):
+        if not LINE_PROTOCOL_HTTP_URL:
+            raise ValueError("LINE_PROTOCOL_HTTP_URL must be set for the line_protocol_http sink")
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Encoding": "gzip", "Content-Type": "text/plain; charset=utf-8"})
+        if LINE_PROTOCOL_HTTP_TOKEN:
+            self.session.headers["Authorization"] = "Bearer " + LINE_PROTOCOL_HTTP_TOKEN
+        super().__init__()
+
+    def write(self, points):
+        # second timestamps scaled to nanoseconds, the default precision of every line protocol receiver
+        for batch in line_protocol_batches([line + "000000000" for line in points_to_line_protocol(points)]):
+            response = self.session.post(LINE_PROTOCOL_HTTP_URL, data=gzip.compress("\n".join(batch).encode(), 5), timeout=60)
+            response.raise_for_status()
+
+# Local single file store, handy for tests and for running without a database
+class SQLiteSink(OutputSink):
+    name = "sqlite"
+
+    def __init__(self):
+        self.connection = sqlite3.connect(SQLITE_SINK_PATH, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS points (measurement TEXT, time TEXT, tags TEXT, fields TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS points_measurement_time ON points (measurement, time)")
+        self.connection_lock = threading.Lock()
+        super().__init__()
+
+    def write(self, points):
+        rows = []
+        for point in points:
+            for point_dict in (point.to_dicts() if isinstance(point, PointBatch) else [point]):
+                rows.append((point_dict["measurement"], point_dict["time"], json.dumps(point_dict.get("tags", {}), sort_keys=True), json.dumps(point_dict["fields"])))
+        with self.connection_lock, self.connection:
+            self.connection.executemany("INSERT INTO points VALUES (?, ?, ?, ?)", rows)
+
+class ParquetArchiveSink(OutputSink):
+    name = "parquet"
+
+    def write(self, points):
+        write_points_to_archive(points)
+
+def create_output_sink(sink_name):
+    if sink_name == "influxdb":
+        if INFLUXDB_VERSION == "2":
+            return InfluxDB2Sink()
+        elif INFLUXDB_VERSION == "1":
+            return InfluxDB1Sink()
         logging.error("No matching version found. Supported values are 1 and 2")
         raise InfluxDBClientError("No matching version found. Supported values are 1 and 2:")
+    sink_classes = {"line_protocol_http": LineProtocolHTTPSink, "sqlite": SQLiteSink, "parquet": ParquetArchiveSink}
+    if sink_name not in sink_classes:
+        raise ValueError("Unknown output sink " + sink_name + ", supported values are influxdb, line_protocol_http, sqlite and parquet")
+    return sink_classes[sink_name]()
+
+if PARQUET_ARCHIVE_PATH and "parquet" not in OUTPUT_SINKS:
+    OUTPUT_SINKS.append("parquet")
+output_sinks = [create_output_sink(sink_name) for sink_name in OUTPUT_SINKS]
+
+def flush_output_sinks():
+    for sink in output_sinks:
+        sink.flush()
+
+atexit.register(flush_output_sinks) # don't lose queued points when the script ends
+signal.signal(signal.SIGTERM, lambda signum, frame : sys.exit(0)) # docker stop sends SIGTERM, exit normally so the atexit flush runs
+
+# Hands the points ( dicts and PointBatch objects ) to every configured output sink
+def write_points_to_influxdb(points):
+    if not points:
+        return
+    for sink in output_sinks:
+        sink.submit(points)
+    if LATEST_VALUE_API_PORT:
+        update_latest_value_cache(points)
+    if INGESTION_LATENCY_TRACKING:
+        latency_points = track_ingestion_latency(points)
+        if latency_points:
+            write_points_to_influxdb(latency_points)
+
+# %% [markdown]
+# ## Ingestion latency tracking
+# freshness_seconds : write time minus the newest point of a measurement in the write.
+# sync_lag_seconds : write time minus the device lastSyncTime, counted once per sync when the written data reaches that sync.
+
+# %%
+LATENCY_WINDOW_SIZE = 500 # lag samples kept per measurement for percentiles
+SYNC_MATCH_TOLERANCE_SECONDS = 300 # newest point within this of lastSyncTime means the synced data has arrived
+last_device_sync_epoch = None
+sync_lag_samples = {} # measurement -> deque of sync lag seconds
+credited_syncs = {} # measurement -> lastSyncTime already counted
+measurement_jobs = {} # measurement -> name of the scheduled job that last produced it
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def newest_point_epoch(point):
+    if isinstance(point, PointBatch):
+        return max(point.times)
+    return datetime.fromisoformat(point["time"]).timestamp()
+
+def track_ingestion_latency(points):
+    newest_by_measurement = {}
+    for point in points:
+        measurement = point.measurement if isinstance(point, PointBatch) else point["measurement"]
+        if measurement == "IngestionLatency" or (isinstance(point, PointBatch) and not len(point)):
+            continue
+        newest_by_measurement[measurement] = max(newest_by_measurement.get(measurement, 0), newest_point_epoch(point))
+    write_epoch = time.time()
+    write_time = datetime.fromtimestamp(int(write_epoch), pytz.utc).isoformat()
+    latency_points = []
+    for measurement, newest_epoch in newest_by_measurement.items():
+        fields = {"freshness_seconds": round(write_epoch - newest_epoch, 1)}
+        # battery level is stamped with lastSyncTime itself, so it says nothing about lag
+        if measurement != "DeviceBatteryLevel" and last_device_sync_epoch and credited_syncs.get(measurement) != last_device_sync_epoch and newest_epoch >= last_device_sync_epoch - SYNC_MATCH_TOLERANCE_SECONDS:
+            credited_syncs[measurement] = last_device_sync_epoch
+            sync_lag = round(write_epoch - last_device_sync_epoch, 1)
+            sync_lag_samples.setdefault(measurement, deque(maxlen=LATENCY_WINDOW_SIZE)).append(sync_lag)
+            fields["sync_lag_seconds"] = sync_lag
+        if sync_lag_samples.get(measurement):
+            sorted_lags = sorted(sync_lag_samples[measurement])
+            fields.update({
+                "sync_lag_p50": percentile(sorted_lags, 0.5),
+                "sync_lag_p90": percentile(sorted_lags, 0.9),
+                "sync_lag_p99": percentile(sorted_lags, 0.99),
+                "sync_lag_samples": len(sorted_lags)
+            })
+        latency_points.append({
+            "measurement": "IngestionLatency",
+            "time": write_time,
+            "tags": {
+                "Device": DEVICENAME,
+                "measurement": measurement,
+                "job": measurement_jobs.get(measurement, "startup")
+            },
+            "fields": fields
+        })
+    return latency_points
+
+# %% [markdown]
+# ## Latest value cache and local api
+# Every written point updates an in memory cache, and the json answers are serialized right away,
+# so a GET is a dictionary lookup. Paths ( measurement names url encoded ) :
+# /latest                   newest point of every series of every measurement
+# /latest/<measurement>     newest point of every series of one measurement
+# /window/<measurement>     the last LATEST_VALUE_WINDOW_SECONDS of every series of one measurement
+
+# %%
+latest_values = {} # measurement -> {series key: {"tags", "epoch", "fields"}}
+window_values = {} # measurement -> {series key: {epoch: fields}}
+latest_value_responses = {} # url path -> serialized json body, replaced whole so readers never need the lock
+latest_value_lock = threading.Lock()
+
+def point_entries(point, since_epoch):
+    """( epoch seconds, fields ) of a point dict or of the points of a batch, from since_epoch on"""
+    if isinstance(point, PointBatch):
+        return [(epoch_seconds, {point.field: value}) for epoch_seconds, value in zip(point.times, point.values) if epoch_seconds >= since_epoch]
+    epoch_seconds = datetime.fromisoformat(point["time"]).timestamp()
+    return [(epoch_seconds, point["fields"])] if epoch_seconds >= since_epoch else []
+
+def update_latest_value_cache(points):
+    changed_measurements = set()
+    with latest_value_lock:
+        for point in points:
+            if isinstance(point, PointBatch) and len(point) == 0:
+                continue
+            measurement = point.measurement if isinstance(point, PointBatch) else point["measurement"]
+            tags = point.tags if isinstance(point, PointBatch) else point.get("tags", {})
+            series_key = tuple(sorted(tags.items()))
+            series_window = window_values.setdefault(measurement, {}).setdefault(series_key, {})
+            newest = newest_point_epoch(point)
+            window_start = max(newest, max(series_window, default=newest)) - LATEST_VALUE_WINDOW_SECONDS
+            for epoch_seconds, fields in point_entries(point, window_start):
+                series_window[epoch_seconds] = {**series_window.get(epoch_seconds, {}), **fields} # fields of one time can arrive in separate points
+            for epoch_seconds in [epoch_seconds for epoch_seconds in series_window if epoch_seconds < window_start]:
+                del series_window[epoch_seconds]
+            series_latest = latest_values.setdefault(measurement, {}).get(series_key)
+            if series_latest is None or newest >= series_latest["epoch"]: # backfilled history never replaces a newer value
+                latest_values[measurement][series_key] = {"tags": dict(tags), "epoch": newest, "fields": series_window[newest]}
+            changed_measurements.add(measurement)
+        for measurement in changed_measurements:
+            latest_value_responses["/latest/" + measurement] = json.dumps(latest_series_json(measurement)).encode()
+            latest_value_responses["/window/" + measurement] = json.dumps([
+                {"tags": dict(series_key), "points": [[epoch_seconds, series_window[epoch_seconds]] for epoch_seconds in sorted(series_window)]}
+                for series_key, series_window in window_values[measurement].items()]).encode()
+        if changed_measurements:
+            latest_value_responses["/latest"] = json.dumps({measurement: latest_series_json(measurement) for measurement in sorted(latest_values)}).encode()
+
+def latest_series_json(measurement):
+    return [{"tags": latest["tags"], "time": datetime.fromtimestamp(latest["epoch"], pytz.utc).isoformat(), "epoch": latest["epoch"], "fields": latest["fields"]}
+            for latest in latest_values.get(measurement, {}).values()]
+
+class LatestValueHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep alive for pollers
+    def do_GET(self):
+        body = latest_value_responses.get(unquote(urlparse(self.path).path).rstrip("/"))
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+    def log_message(self, format, *args):
+        logging.debug("Latest value api : " + format % args)
+
+if LATEST_VALUE_API_PORT:
+    latest_value_server = ThreadingHTTPServer(("0.0.0.0", LATEST_VALUE_API_PORT), LatestValueHandler)
+    latest_value_server.daemon_threads = True
+    threading.Thread(target=latest_value_server.serve_forever, name="latest-value-api", daemon=True).start()
+    logging.info("Serving latest values on port " + str(LATEST_VALUE_API_PORT))
+
+# %% [markdown]
+# ## Parquet archive ( optional )
+# One directory per measurement, one partition per UTC day, typed columns : time, one column per tag and per field.
+# Every write adds a part file, and re-fetched data ( e.g. today's intraday data every few minutes ) lands again in a new part.
+# Reads and compact_archive_partitions keep one row per time and tags, with the latest value of every field.
+# Small part files appended during the day are merged by compact_archive_partitions. Files only appear under their final
+# name once complete, and a compaction records the parts it merges in a manifest before swapping in its output, so a crash
+# at any point leaves every point in exactly one readable file.
+
+# %%
+if PARQUET_ARCHIVE_PATH and pyarrow is None:
+    logging.error("PARQUET_ARCHIVE_PATH is set but pyarrow is not installed! Run pip install pyarrow")
+    raise ImportError("pyarrow is required for PARQUET_ARCHIVE_PATH")
+
+def archive_partition_path(measurement, date_str):
+    safe_measurement = "".join(char if char.isalnum() else "_" for char in measurement)
+    return os.path.join(PARQUET_ARCHIVE_PATH, safe_measurement, "date=" + date_str)
+
+ARCHIVE_TAGS_METADATA_KEY = b"fitbit_tags" # Parquet schema metadata listing the tag columns, the dedupe key besides time
+
+def infer_archive_column_type(values):
+    value_types = {type(value) for value in values if value is not None}
+    if not value_types:
+        return pyarrow.null() # Takes the type of the other parts when partitions are read or compacted
+    if value_types == {bool}:
+        return pyarrow.bool_()
+    if value_types and value_types <= {int}:
+        return pyarrow.int64()
+    if value_types and value_types <= {int, float}:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+def points_to_arrow_table(points):
+    times = [datetime.fromisoformat(point["time"]).astimezone(pytz.utc) for point in points]
+    columns = {"time": pyarrow.array(times, type=pyarrow.timestamp("us", tz="UTC"))}
+    tag_names = sorted({tag for point in points for tag in point.get("tags", {})})
+    field_names = sorted({field for point in points for field in point["fields"]})
+    for tag in tag_names:
+        columns[tag] = pyarrow.array([None if point.get("tags", {}).get(tag) is None else str(point["tags"][tag]) for point in points], type=pyarrow.string())
+    for field in field_names:
+        if field in columns:
+            continue # a tag with the same name wins
+        values = [point["fields"].get(field) for point in points]
+        column_type = infer_archive_column_type(values)
+        if column_type == pyarrow.string():
+            values = [None if value is None else str(value) for value in values]
+        elif column_type == pyarrow.float64():
+            values = [None if value is None else float(value) for value in values]
+        columns[field] = pyarrow.array(values, type=column_type)
+    return with_archive_tags(pyarrow.table(columns), tag_names)
+
+def with_archive_tags(table, tag_names):
+    return table.replace_schema_metadata({ARCHIVE_TAGS_METADATA_KEY: json.dumps(sorted(tag_names)).encode()})
+
+def archive_tag_names(table):
+    metadata = table.schema.metadata or {}
+    if ARCHIVE_TAGS_METADATA_KEY in metadata:
+        return json.loads(metadata[ARCHIVE_TAGS_METADATA_KEY])
+    return [field.name for field in table.schema if field.name != "time" and pyarrow.types.is_string(field.type)] # Untagged older parts, tags are the string columns
+
+def concat_archive_tables(tables):
+    if int(pyarrow.__version__.split(".")[0]) >= 14:
+        return pyarrow.concat_tables(tables, promote_options="permissive")
+    return pyarrow.concat_tables(tables, promote=True)
+
+def dedupe_archive_table(table, tag_names):
+    """One row per time and tags holding the last non-null value of every field, like repeated writes to InfluxDB.
+    Later rows win, so tables must be concatenated oldest part first"""
+    keys = ["time"] + [name for name in tag_names if name in table.column_names]
+    null_columns = {field.name for field in table.schema if pyarrow.types.is_null(field.type)} - set(keys)
+    value_columns = [name for name in table.column_names if name not in keys and name not in null_columns]
+    # use_threads=False keeps the row order that "last" relies on
+    grouped = table.group_by(keys, use_threads=False).aggregate([(name, "last") for name in value_columns])
+    columns = {name: pyarrow.nulls(grouped.num_rows) if name in null_columns else grouped.column(name if name in keys else name + "_last") for name in table.column_names}
+    return with_archive_tags(pyarrow.table(columns).sort_by("time"), keys[1:])
+
+def read_archive_partition(directory, part_files=None):
+    """The parts of a partition ( default all ) as one deduplicated table, None when it has no parts"""
+    tables = [pyarrow.parquet.read_table(os.path.join(directory, name), memory_map=True) for name in (archive_part_files(directory) if part_files is None else part_files)]
+    if not tables:
+        return None
+    return dedupe_archive_table(concat_archive_tables(tables), {tag for table in tables for tag in archive_tag_names(table)})
+
+# A PointBatch maps straight onto columns, split into one table per UTC day
+def point_batch_to_arrow_tables(batch):
+    tables_by_date = {}
+    day_numbers = [epoch_seconds // 86400 for epoch_seconds in batch.times]
+    for day_number in sorted(set(day_numbers)):
+        indexes = [index for index, number in enumerate(day_numbers) if number == day_number]
+        times = pyarrow.array([batch.times[index] for index in indexes], type=pyarrow.int64()).cast(pyarrow.timestamp("s", tz="UTC")).cast(pyarrow.timestamp("us", tz="UTC"))
+        columns = {"time": times}
+        for tag, value in batch.tags.items():
+            columns[tag] = pyarrow.array([str(value)] * len(indexes), type=pyarrow.string())
+        columns[batch.field] = pyarrow.array([batch.values[index] for index in indexes], type=pyarrow.int64() if batch.values.typecode == 'q' else pyarrow.float64())
+        tables_by_date[datetime.fromtimestamp(day_number * 86400, pytz.utc).strftime("%Y-%m-%d")] = with_archive_tags(pyarrow.table(columns), batch.tags)
+    return tables_by_date
+
+def write_points_to_archive(points):
+    partitions = {}
+    for point in points:
+        if isinstance(point, PointBatch):
+            for date_str, table in point_batch_to_arrow_tables(point).items():
+                partitions.setdefault((point.measurement, date_str), []).append(table)
+            continue
+        utc_date = datetime.fromisoformat(point["time"]).astimezone(pytz.utc).strftime("%Y-%m-%d")
+        partitions.setdefault((point["measurement"], utc_date), []).append(point)
+    for (measurement, date_str), partition_points in partitions.items():
+        directory = archive_partition_path(measurement, date_str)
+        os.makedirs(directory, exist_ok=True)
+        point_dicts = [point for point in partition_points if isinstance(point, dict)]
+        tables = [table for table in partition_points if not isinstance(table, dict)] + ([points_to_arrow_table(point_dicts)] if point_dicts else [])
+        table = dedupe_archive_table(concat_archive_tables(tables), {tag for table in tables for tag in archive_tag_names(table)})
+        part_name = "part-" + str(time.time_ns()) + ".parquet"
+        pyarrow.parquet.write_table(table, os.path.join(directory, "." + part_name + ".tmp"), compression="zstd")
+        os.replace(os.path.join(directory, "." + part_name + ".tmp"), os.path.join(directory, part_name))
+    logging.info("Archived " + str(len(points)) + " points / batches in " + str(len(partitions)) + " parquet partitions")
+
+ARCHIVE_COMPACTION_MANIFEST = ".compaction.json" # {"output": compacted file name, "merged": part file names it replaces}
+
+def read_compaction_manifest(directory):
+    try:
+        with open(os.path.join(directory, ARCHIVE_COMPACTION_MANIFEST), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def archive_part_files(directory):
+    """Parquet files of a partition oldest first ( compacted-* before the part-* written since ), minus the parts an
+    interrupted compaction has already merged into its output"""
+    part_files = sorted(name for name in os.listdir(directory) if name.endswith(".parquet"))
+    manifest = read_compaction_manifest(directory)
+    if manifest is not None and manifest["output"] in part_files:
+        part_files = [name for name in part_files if name not in manifest["merged"]]
+    return part_files
+
+def finish_interrupted_compaction(directory):
+    """Completes a compaction whose output made it to disk, or drops one that never got that far"""
+    manifest = read_compaction_manifest(directory)
+    if manifest is None:
+        return
+    if os.path.exists(os.path.join(directory, manifest["output"])):
+        for name in manifest["merged"]:
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+    elif os.path.exists(os.path.join(directory, ".compacting.tmp")):
+        os.remove(os.path.join(directory, ".compacting.tmp"))
+    os.remove(os.path.join(directory, ARCHIVE_COMPACTION_MANIFEST))
+
+# Merges the part files of every partition into a single file, skipping today's still growing partition
+def compact_archive_partitions():
+    today_str = datetime.now(pytz.utc).strftime("%Y-%m-%d")
+    compacted = 0
+    for measurement_dir in os.listdir(PARQUET_ARCHIVE_PATH):
+        for partition_dir in os.listdir(os.path.join(PARQUET_ARCHIVE_PATH, measurement_dir)):
+            directory = os.path.join(PARQUET_ARCHIVE_PATH, measurement_dir, partition_dir)
+            finish_interrupted_compaction(directory)
+            part_files = archive_part_files(directory)
+            if len(part_files) < 2 or partition_dir == "date=" + today_str:
+                continue
+            table = read_archive_partition(directory, part_files)
+            temp_path = os.path.join(directory, ".compacting.tmp")
+            pyarrow.parquet.write_table(table, temp_path, compression="zstd")
+            output_name = "compacted-" + str(time.time_ns()) + ".parquet"
+            # From here on a crash is finished by the next run : the manifest says which parts the output replaces
+            write_json_atomically(os.path.join(directory, ARCHIVE_COMPACTION_MANIFEST), {"output": output_name, "merged": part_files})
+            os.replace(temp_path, os.path.join(directory, output_name))
+            for name in part_files:
+                os.remove(os.path.join(directory, name))
+            os.remove(os.path.join(directory, ARCHIVE_COMPACTION_MANIFEST))
+            compacted += 1
+    logging.info("Compacted " + str(compacted) + " parquet archive partitions")
+
+def read_archive(measurement, start_date_str, end_date_str, columns=None):
+    """Yields (date, pyarrow table) one memory mapped partition at a time, so years of data never sit in memory at once"""
+    measurement_path = os.path.dirname(archive_partition_path(measurement, start_date_str))
+    if not os.path.isdir(measurement_path):
+        return
+    for partition_dir in sorted(os.listdir(measurement_path)):
+        date_str = partition_dir[len("date="):]
+        if not start_date_str <= date_str <= end_date_str:
+            continue
+        directory = os.path.join(measurement_path, partition_dir)
+        table = read_archive_partition(directory) # All columns, the tag columns are needed to dedupe
+        if table is not None:
+            yield date_str, table.select(columns) if columns else table
+
+# %% [markdown]
+# ## InfluxDB downsampling and retention provisioning
+# Rollups are computed server side ( 2.x tasks, 1.x continuous queries ) into a separate bucket / retention policy as
+# <measurement>_<window> with <function>_<field> fields. Raw points older than raw_retention_days are deleted daily,
+# right after a rollup of everything being deleted, so history the tasks never saw ( the data that was there
+# before provisioning, bulk backfills of old dates ) is rolled up before it goes. That rollup and the delete go a day at
+# a time from the oldest raw point, so the first run over years of history stays within the client timeout.
+# Everything this script provisions is named fitbit_downsample_*, on startup missing ones are created, changed ones
+# updated and ones no longer in DOWNSAMPLING_RULES removed.
+
+# %%
+# measurement : raw retention in days ( 0 keeps raw data forever ) and ( window, aggregate functions ) rollups
+DOWNSAMPLING_RULES = {
+    "HeartRate_Intraday": {"raw_retention_days": 30, "rollups": [("1m", ["mean", "min", "max"]), ("1h", ["mean", "min", "max"])]},
+    "Steps_Intraday": {"raw_retention_days": 90, "rollups": [("1h", ["sum"])]},
+    "SPO2_Intraday": {"raw_retention_days": 90, "rollups": [("10m", ["mean", "min"])]},
+}
+DOWNSAMPLING_NAME_PREFIX = "fitbit_downsample_"
+
+def duration_seconds(duration):
+    return int(duration[:-1]) * {"m": 60, "h": 3600, "d": 86400}[duration[-1]]
+
+# Short windows are computed hourly, over a range covering the two previous runs to pick up late synced data
+def downsampling_task_every(window):
+    return window if duration_seconds(window) >= 3600 else "1h"
+
+def downsampling_flux_pipeline(measurement, window, functions, flux_range):
+    flux = 'data = from(bucket: "' + INFLUXDB_BUCKET + '")\n    |> range(' + flux_range + ')\n    |> filter(fn: (r) => r._measurement == "' + measurement + '")\n'
+    for function in functions:
+        flux += '\ndata\n    |> aggregateWindow(every: ' + window + ', fn: ' + function + ', createEmpty: false)\n    |> map(fn: (r) => ({r with _measurement: "' + measurement + '_' + window + '", _field: "' + function + '_" + r._field}))\n    |> to(bucket: "' + INFLUXDB_ROLLUP_BUCKET + '", org: "' + INFLUXDB_ORG + '")\n'
+    return flux
+
+def downsampling_flux(measurement, window, functions):
+    every = downsampling_task_every(window)
+    task_name = DOWNSAMPLING_NAME_PREFIX + measurement + "_" + window
+    flux = 'option task = {name: "' + task_name + '", every: ' + every + ', offset: 5m}\n\n'
+    flux += downsampling_flux_pipeline(measurement, window, functions, 'start: -' + str(3 * duration_seconds(every)) + 's')
+    return task_name, flux
+
+def reconcile_downsampling_v2(client):
+    buckets_api = client.buckets_api()
+    retention_rules = [BucketRetentionRules(type="expire", every_seconds=INFLUXDB_ROLLUP_RETENTION_DAYS * 86400)] if INFLUXDB_ROLLUP_RETENTION_DAYS else []
+    rollup_bucket = buckets_api.find_bucket_by_name(INFLUXDB_ROLLUP_BUCKET)
+    if rollup_bucket is None:
+        buckets_api.create_bucket(bucket_name=INFLUXDB_ROLLUP_BUCKET, retention_rules=retention_rules, org=INFLUXDB_ORG)
+        logging.info("Created rollup bucket " + INFLUXDB_ROLLUP_BUCKET)
+    elif [rule.every_seconds for rule in rollup_bucket.retention_rules or [] if rule.every_seconds] != [rule.every_seconds for rule in retention_rules]:
+        rollup_bucket.retention_rules = retention_rules
+        buckets_api.update_bucket(bucket=rollup_bucket)
+        logging.info("Updated retention of rollup bucket " + INFLUXDB_ROLLUP_BUCKET)
+
+    tasks_api = client.tasks_api()
+    existing_tasks = {task.name: task for task in tasks_api.find_tasks(org=INFLUXDB_ORG) if task.name.startswith(DOWNSAMPLING_NAME_PREFIX)}
+    wanted_tasks = dict(downsampling_flux(measurement, window, functions) for measurement, rule in DOWNSAMPLING_RULES.items() for window, functions in rule["rollups"])
+    for task_name, flux in wanted_tasks.items():
+        if task_name not in existing_tasks:
+            tasks_api.create_task(task_create_request=TaskCreateRequest(flux=flux, org=INFLUXDB_ORG, status="active", description="Managed by Fitbit_Fetch"))
+            logging.info("Created downsampling task " + task_name)
+        elif existing_tasks[task_name].flux.strip() != flux.strip():
+            tasks_api.update_task_request(existing_tasks[task_name].id, TaskUpdateRequest(flux=flux))
+            logging.info("Updated downsampling task " + task_name)
+    for task_name, task in existing_tasks.items():
+        if task_name not in wanted_tasks:
+            tasks_api.delete_task(task.id)
+            logging.info("Deleted stale downsampling task " + task_name)
+
+def downsampling_select_into(measurement, window, functions, where=""):
+    select = ", ".join(function + "(*)" for function in functions) # fields come out as <function>_<field>
+    return 'SELECT ' + select + ' INTO "' + INFLUXDB_DATABASE + '"."' + INFLUXDB_ROLLUP_RETENTION_POLICY + '"."' + measurement + '_' + window + '" FROM "' + measurement + '"' + where + ' GROUP BY time(' + window + '), *'
+
+# 1.x continuous queries can't be altered, so the name carries a hash of the definition and a changed rule replaces the query
+def downsampling_continuous_query(measurement, window, functions):
+    every = downsampling_task_every(window)
+    query = downsampling_select_into(measurement, window, functions)
+    query_name = DOWNSAMPLING_NAME_PREFIX + measurement + "_" + window + "_" + hashlib.sha1(query.encode()).hexdigest()[:8]
+    return query_name, 'CREATE CONTINUOUS QUERY "' + query_name + '" ON "' + INFLUXDB_DATABASE + '" RESAMPLE EVERY ' + every + ' FOR ' + str(3 * duration_seconds(every)) + 's BEGIN ' + query + ' END'
+
+def reconcile_downsampling_v1(client):
+    rollup_duration = str(INFLUXDB_ROLLUP_RETENTION_DAYS) + "d" if INFLUXDB_ROLLUP_RETENTION_DAYS else "INF"
+    existing_policies = {policy["name"]: policy for policy in client.get_list_retention_policies(INFLUXDB_DATABASE)}
+    if INFLUXDB_ROLLUP_RETENTION_POLICY not in existing_policies:
+        client.create_retention_policy(INFLUXDB_ROLLUP_RETENTION_POLICY, rollup_duration, 1, database=INFLUXDB_DATABASE)
+        logging.info("Created rollup retention policy " + INFLUXDB_ROLLUP_RETENTION_POLICY)
+    elif duration_seconds_v1(existing_policies[INFLUXDB_ROLLUP_RETENTION_POLICY]["duration"]) != INFLUXDB_ROLLUP_RETENTION_DAYS * 86400:
+        client.alter_retention_policy(INFLUXDB_ROLLUP_RETENTION_POLICY, database=INFLUXDB_DATABASE, duration=rollup_duration)
+        logging.info("Updated rollup retention policy " + INFLUXDB_ROLLUP_RETENTION_POLICY)
+
+    existing_queries = {query["name"] for database in client.get_list_continuous_queries() for query in database.get(INFLUXDB_DATABASE, []) if query["name"].startswith(DOWNSAMPLING_NAME_PREFIX)}
+    wanted_queries = dict(downsampling_continuous_query(measurement, window, functions) for measurement, rule in DOWNSAMPLING_RULES.items() for window, functions in rule["rollups"])
+    for query_name, statement in wanted_queries.items():
+        if query_name not in existing_queries:
+            client.query(statement)
+            logging.info("Created continuous query " + query_name)
+    for query_name in existing_queries - set(wanted_queries):
+        client.query('DROP CONTINUOUS QUERY "' + query_name + '" ON "' + INFLUXDB_DATABASE + '"')
+        logging.info("Dropped stale continuous query " + query_name)
+
+# "720h0m0s" style 1.x durations to seconds, "0s" is infinite
+def duration_seconds_v1(duration):
+    return sum(int(amount) * {"h": 3600, "m": 60, "s": 1}[unit] for amount, unit in re.findall(r"(\d+)([hms])", duration))
+
+RAW_ROLLUP_CHUNK_SECONDS = 86400 # Raw points rolled up and deleted per query, a multiple of every rollup window
+
+def influx_time(epoch):
+    return datetime.fromtimestamp(epoch, pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def raw_retention_cutoff(rule, now_epoch):
+    """Retention cutoff epoch rounded down to the longest rollup window, so no window is split between the rollup and the delete"""
+    longest_window = max((duration_seconds(window) for window, functions in rule["rollups"]), default=1)
+    cutoff_epoch = int(now_epoch) - rule["raw_retention_days"] * 86400
+    return cutoff_epoch - cutoff_epoch % longest_window
+
+def oldest_raw_point_epoch(client, measurement, cutoff_epoch):
+    """Time of the oldest raw point before the cutoff, None when there is none"""
+    if isinstance(client, InfluxDBClient2):
+        flux = 'from(bucket: "' + INFLUXDB_BUCKET + '")\n    |> range(start: 0, stop: ' + influx_time(cutoff_epoch) + ')\n    |> filter(fn: (r) => r._measurement == "' + measurement + '")\n    |> first()'
+        times = [record.get_time() for table in client.query_api().query(flux, org=INFLUXDB_ORG) for record in table.records]
+        return int(min(times).timestamp()) if times else None
+    points = list(client.query('SELECT * FROM "' + measurement + '" WHERE time < \'' + influx_time(cutoff_epoch) + '\' ORDER BY time ASC LIMIT 1', epoch='s').get_points())
+    return points[0]["time"] if points else None
+
+def raw_rollup_chunks(oldest_epoch, cutoff_epoch):
+    """( start, stop ) epochs of whole chunks from the one holding the oldest raw point, the last one ending at the cutoff"""
+    chunk_start = oldest_epoch - oldest_epoch % RAW_ROLLUP_CHUNK_SECONDS
+    while chunk_start < cutoff_epoch:
+        yield chunk_start, min(chunk_start + RAW_ROLLUP_CHUNK_SECONDS, cutoff_epoch)
+        chunk_start += RAW_ROLLUP_CHUNK_SECONDS
+
+def delete_expired_raw_points(client, now_epoch=None):
+    """Rolls up the raw points older than the cutoff a chunk at a time, deleting each chunk once it is rolled up. Raw points
+    still there from before the last run are rolled up again, which rewrites the same rollup points. A failed rollup
+    raises before its chunk is deleted"""
+    for measurement, rule in DOWNSAMPLING_RULES.items():
+        if not rule["raw_retention_days"]:
+            continue
+        cutoff_epoch = raw_retention_cutoff(rule, time.time() if now_epoch is None else now_epoch)
+        oldest_epoch = oldest_raw_point_epoch(client, measurement, cutoff_epoch)
+        if oldest_epoch is None:
+            continue
+        for chunk_start, chunk_stop in raw_rollup_chunks(oldest_epoch, cutoff_epoch):
+            if isinstance(client, InfluxDBClient2):
+                for window, functions in rule["rollups"]:
+                    client.query_api().query(downsampling_flux_pipeline(measurement, window, functions, 'start: ' + influx_time(chunk_start) + ', stop: ' + influx_time(chunk_stop)), org=INFLUXDB_ORG)
+                # The delete range is inclusive, points are written with second precision
+                client.delete_api().delete("1970-01-01T00:00:00Z", influx_time(chunk_stop - 1), '_measurement="' + measurement + '"', bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG)
+            else:
+                for window, functions in rule["rollups"]:
+                    client.query(downsampling_select_into(measurement, window, functions, " WHERE time >= '" + influx_time(chunk_start) + "' AND time < '" + influx_time(chunk_stop) + "'"))
+                client.query('DELETE FROM "' + measurement + '" WHERE time < \'' + influx_time(chunk_stop) + '\'')
+        logging.info("Rolled up and deleted raw " + measurement + " points from " + influx_time(oldest_epoch) + " to " + influx_time(cutoff_epoch))
+
+def downsampling_influxdb_client():
+    for sink in output_sinks:
+        if isinstance(sink, (InfluxDB1Sink, InfluxDB2Sink)):
+            return sink.client
+    return None
+
+if INFLUXDB_DOWNSAMPLING:
+    if downsampling_influxdb_client() is None:
+        logging.error("INFLUXDB_DOWNSAMPLING needs the influxdb output sink, skipping provisioning")
+    else:
+        try:
+            if INFLUXDB_VERSION == "2":
+                reconcile_downsampling_v2(downsampling_influxdb_client())
+            else:
+                reconcile_downsampling_v1(downsampling_influxdb_client())
+        except (InfluxDBError, InfluxDBClientError, requests.exceptions.RequestException) as err:
+            logging.error("Downsampling provisioning failed! " + str(err))
 
 # %% [markdown]
 # ## Set Timezone from profile data
 
 # %%
-if LOCAL_TIMEZONE == "Automatic":
-    LOCAL_TIMEZONE = pytz.timezone(request_data_from_fitbit("https://api.fitbit.com/1/user/-/profile.json")["user"]["timezone"])
+if LOCAL_TIMEZONE == "Automatic" and TAKEOUT_IMPORT_PATH:
+    logging.error("LOCAL_TIMEZONE=Automatic needs the Fitbit API, set an explicit timezone for Takeout import")
+    raise ValueError("LOCAL_TIMEZONE must be set explicitly for Takeout import")
+elif LOCAL_TIMEZONE == "Automatic" and SIMULATE_SCHEDULE:
+    LOCAL_TIMEZONE = pytz.utc # Only used to build the job table
+elif LOCAL_TIMEZONE == "Automatic":
+    # Reuse the timezone resolved by a previous run for a week, saves the profile call on every restart
+    cached_timezone = persisted_state.get("profile_timezone", {})
+    if cached_timezone and time.time() - cached_timezone["resolved_at"] < 7 * 86400:
+        LOCAL_TIMEZONE = pytz.timezone(cached_timezone["name"])
+    else:
+        LOCAL_TIMEZONE = pytz.timezone(request_data_from_fitbit("https://api.fitbit.com/1/user/-/profile.json")["user"]["timezone"])
+        save_state("profile_timezone", {"name": LOCAL_TIMEZONE.zone, "resolved_at": time.time()})
 else:
     LOCAL_TIMEZONE = pytz.timezone(LOCAL_TIMEZONE)
 
@@ -216,7 +1385,7 @@ else:
 # ## Selecting Dates for update
 
 # %%
-if AUTO_DATE_RANGE:
+if AUTO_DATE_RANGE or TAKEOUT_IMPORT_PATH or SIMULATE_SCHEDULE: # Takeout import covers whatever the export contains
     end_date = datetime.now(LOCAL_TIMEZONE)
     start_date = end_date - timedelta(days=auto_update_date_range)
     end_date_str = end_date.strftime("%Y-%m-%d")
@@ -233,6 +1402,40 @@ else:
 # %%
 collected_records = []
 
+# Bulk pipeline : fetchers run in the main process, the heavy payload -> points transforms run in worker
+# processes, and the writer takes the results in fetch order. Outside bulk mode transforms run inline.
+transform_executor = None
+pending_transforms = deque() # Futures of point lists, in fetch order
+
+def record_points(transform, *args):
+    """Collects the points of a pure transform ( raw payload -> points ). Returns them, or None when handed to a worker"""
+    if transform_executor is None:
+        points = transform(*args)
+        collected_records.extend(points)
+        return points
+    queue_collected_records() # Points recorded inline so far stay ahead of this payload
+    pending_transforms.append(transform_executor.submit(transform, *args))
+    drain_transforms(BULK_PIPELINE_DEPTH)
+    return None
+
+def queue_collected_records():
+    if collected_records:
+        finished = Future()
+        finished.set_result(collected_records[:])
+        pending_transforms.append(finished)
+        collected_records.clear()
+
+def drain_transforms(max_pending):
+    """Writes transform results in order, waiting on the oldest ones until at most max_pending remain"""
+    while pending_transforms and (len(pending_transforms) > max_pending or pending_transforms[0].done()):
+        try:
+            points = pending_transforms.popleft().result()
+        except Exception as e:
+            logging.error("Bulk transform failed, skipping its payload : " + str(e))
+            continue
+        if points:
+            write_points_to_influxdb(points)
+
 def update_working_dates():
     global end_date, start_date, end_date_str, start_date_str
     end_date = datetime.now(LOCAL_TIMEZONE)
@@ -242,8 +1445,11 @@ def update_working_dates():
 
 # Get last synced battery level of the device
 def get_battery_level():
-    device = request_data_from_fitbit("https://api.fitbit.com/1/user/-/devices.json")[0]
+    global last_device_sync_epoch
+    devices = request_data_from_fitbit("https://api.fitbit.com/1/user/-/devices.json")
+    device = devices[0] if devices else None
     if device != None:
+        last_device_sync_epoch = LOCAL_TIMEZONE.localize(datetime.fromisoformat(device['lastSyncTime'])).timestamp()
         collected_records.append({
             "measurement": "DeviceBatteryLevel",
             "time": LOCAL_TIMEZONE.localize(datetime.fromisoformat(device['lastSyncTime'])).astimezone(pytz.utc).isoformat(),
@@ -251,36 +1457,137 @@ def get_battery_level():
                 "value": float(device['batteryLevel'])
             }
         })
+        save_state("device", {key: device.get(key) for key in ("id", "deviceVersion", "type", "lastSyncTime", "batteryLevel")})
         logging.info("Recorded battery level for " + DEVICENAME)
     else:
         logging.error("Recording battery level failed : " + DEVICENAME)
 
-# For intraday detailed data, max possible range in one day.
-def get_intraday_data_limit_1d(date_str, measurement_list):
-    for measurement in measurement_list:
-        data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/' + measurement[0] + '/date/' + date_str + '/1d/' + measurement[2] + '.json')["activities-" + measurement[0] + "-intraday"]['dataset']
-        if data != None:
-            for value in data:
-                log_time = datetime.fromisoformat(date_str + "T" + value['time'])
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                collected_records.append({
-                        "measurement":  measurement[1],
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME
-                        },
-                        "fields": {
-                            "value": int(value['value'])
-                        }
-                    })
-            logging.info("Recorded " +  measurement[1] + " intraday for date " + date_str)
+# Intraday parsers : ( catalog entry, json response, date ) -> points
+def parse_activity_intraday(resource, data, date_str):
+    batch = PointBatch(resource["measurement"], {"Device": DEVICENAME}, value_typecode=resource["value_typecode"])
+    value_type = int if resource["value_typecode"] == 'q' else float
+    hour_start_cache = {}
+    for value in data.get("activities-" + resource["name"] + "-intraday", {}).get('dataset', []):
+        batch.append(local_time_to_epoch_seconds(date_str + "T" + value['time'], hour_start_cache), value_type(value['value']))
+    return [batch] if len(batch) else []
+
+def parse_active_zone_minutes_intraday(resource, data, date_str):
+    batch = PointBatch(resource["measurement"], {"Device": DEVICENAME}, value_typecode='q')
+    hour_start_cache = {}
+    for day in data.get("activities-active-zone-minutes-intraday", []):
+        for record in day.get("minutes", []):
+            batch.append(local_time_to_epoch_seconds(record["minute"], hour_start_cache), int(record["value"].get("activeZoneMinutes", 0)))
+    return [batch] if len(batch) else []
+
+def parse_spo2_intraday(resource, data, date_str):
+    batch = PointBatch(resource["measurement"], {"Device": DEVICENAME}, value_typecode='d')
+    hour_start_cache = {}
+    for day in (data if isinstance(data, list) else [data]): # a single date returns one object, a range returns a list
+        for record in day.get("minutes", []):
+            batch.append(local_time_to_epoch_seconds(record["minute"], hour_start_cache), float(record["value"]))
+    return [batch] if len(batch) else []
+
+def parse_hrv_intraday(resource, data, date_str):
+    points = []
+    for day in data.get("hrv", []):
+        for record in day.get("minutes", []):
+            points.append({
+                "measurement": resource["measurement"],
+                "time": local_time_to_utc_iso(datetime.fromisoformat(record["minute"][:19])),
+                "tags": {"Device": DEVICENAME},
+                "fields": {key: float(value) for key, value in record["value"].items()} # rmssd, coverage, hf, lf
+            })
+    return points
+
+def parse_br_intraday(resource, data, date_str):
+    points = []
+    for day in data.get("br", []):
+        fields = {summary_name.replace("SleepSummary", ""): float(summary["breathingRate"]) for summary_name, summary in day.get("value", {}).items() if summary.get("breathingRate") is not None}
+        if fields: # one rate per sleep stage : deep, rem, light, full
+            points.append({
+                "measurement": resource["measurement"],
+                "time": local_time_to_utc_iso(datetime.fromisoformat(day["dateTime"] + "T00:00:00")),
+                "tags": {"Device": DEVICENAME},
+                "fields": fields
+            })
+    return points
+
+# Every intraday resource that can be collected. Enable them with INTRADAY_RESOURCES, priority steers the request budget
+INTRADAY_RESOURCE_CATALOG = {resource["name"]: resource for resource in [
+    {"name": "heart", "measurement": "HeartRate_Intraday", "url": "activities/heart/date/{date}/1d/1sec.json", "parser": parse_activity_intraday, "value_typecode": 'q', "priority": 10},
+    {"name": "steps", "measurement": "Steps_Intraday", "url": "activities/steps/date/{date}/1d/1min.json", "parser": parse_activity_intraday, "value_typecode": 'q', "priority": 8},
+    {"name": "calories", "measurement": "Calories_Intraday", "url": "activities/calories/date/{date}/1d/1min.json", "parser": parse_activity_intraday, "value_typecode": 'd', "priority": 4},
+    {"name": "distance", "measurement": "Distance_Intraday", "url": "activities/distance/date/{date}/1d/1min.json", "parser": parse_activity_intraday, "value_typecode": 'd', "priority": 3},
+    {"name": "floors", "measurement": "Floors_Intraday", "url": "activities/floors/date/{date}/1d/1min.json", "parser": parse_activity_intraday, "value_typecode": 'q', "priority": 2},
+    {"name": "elevation", "measurement": "Elevation_Intraday", "url": "activities/elevation/date/{date}/1d/1min.json", "parser": parse_activity_intraday, "value_typecode": 'd', "priority": 2},
+    {"name": "active-zone-minutes", "measurement": "ActiveZoneMinutes_Intraday", "url": "activities/active-zone-minutes/date/{date}/1d/1min.json", "parser": parse_active_zone_minutes_intraday, "priority": 5},
+    {"name": "hrv", "measurement": "HRV_Intraday", "url": "hrv/date/{date}/all.json", "range_url": "hrv/date/{start}/{end}/all.json", "max_span_days": 30, "parser": parse_hrv_intraday, "priority": 3}, # sleep only, changes once a day
+    {"name": "br", "measurement": "BreathingRate_Intraday", "url": "br/date/{date}/all.json", "range_url": "br/date/{start}/{end}/all.json", "max_span_days": 30, "parser": parse_br_intraday, "priority": 1},
+    {"name": "spo2", "measurement": "SPO2_Intraday", "url": "spo2/date/{date}/all.json", "range_url": "spo2/date/{start}/{end}/all.json", "max_span_days": 30, "parser": parse_spo2_intraday, "priority": 2}, # also covered by get_daily_data_limit_30d
+]}
+
+unknown_intraday_resources = set(INTRADAY_RESOURCES) - set(INTRADAY_RESOURCE_CATALOG)
+if unknown_intraday_resources:
+    raise ValueError("Unknown INTRADAY_RESOURCES " + ", ".join(sorted(unknown_intraday_resources)) + ", choose from " + ", ".join(INTRADAY_RESOURCE_CATALOG))
+
+# Fetches and records one intraday resource, returns the newest point epoch ( None when no data )
+def fetch_intraday_resource(resource, url_path, date_str, date_label):
+    data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/' + url_path)
+    if data == None:
+        logging.error("Recording failed : " +  resource["measurement"] + " intraday for date " + date_label)
+        return None
+    points = record_points(resource["parser"], resource, data, date_str)
+    logging.info("Recorded " +  resource["measurement"] + " intraday for date " + date_label)
+    return max(newest_point_epoch(point) for point in points) if points else None
+
+# For intraday detailed data, max possible range in one day. Returns the newest point epoch per resource ( None when no data )
+def get_intraday_data_limit_1d(date_str, resource_names=INTRADAY_RESOURCES):
+    newest_by_resource = {}
+    for resource_name in resource_names:
+        resource = INTRADAY_RESOURCE_CATALOG[resource_name]
+        newest_by_resource[resource_name] = fetch_intraday_resource(resource, resource["url"].format(date=date_str), date_str, date_str)
+    return newest_by_resource
+
+# Intraday data for several days, resources with a range_url are fetched in ranges of up to max_span_days
+def get_intraday_data_for_dates(date_strs, resource_names=INTRADAY_RESOURCES):
+    for resource_name in resource_names:
+        resource = INTRADAY_RESOURCE_CATALOG[resource_name]
+        if "range_url" in resource:
+            for start_date_str, end_date_str in plan_date_ranges(date_strs, resource["max_span_days"]):
+                fetch_intraday_resource(resource, resource["range_url"].format(start=start_date_str, end=end_date_str), start_date_str, start_date_str + " to " + end_date_str)
         else:
-            logging.error("Recording failed : " +  measurement[1] + " intraday for date " + date_str)
+            for date_str in sorted(set(date_strs)):
+                fetch_intraday_resource(resource, resource["url"].format(date=date_str), date_str, date_str)
+
+# Cost aware scheduling of today's intraday resources. Each resource earns request credit from INTRADAY_HOURLY_REQUEST_BUDGET
+# in proportion to priority x observed change rate, and is fetched whenever it holds a full request worth of credit.
+INTRADAY_MIN_CHANGE_WEIGHT = 0.2 # resources that stopped changing still get polled at this fraction of their priority
+intraday_schedule_state = {resource_name: {"credit": 1.0, "change_rate": 1.0, "newest": None, "last_tick": None} for resource_name in INTRADAY_RESOURCES}
+
+def run_intraday_scheduler(date_str):
+    now = time.time()
+    weights = {name: INTRADAY_RESOURCE_CATALOG[name]["priority"] * (INTRADAY_MIN_CHANGE_WEIGHT + (1 - INTRADAY_MIN_CHANGE_WEIGHT) * state["change_rate"]) for name, state in intraday_schedule_state.items()}
+    total_weight = sum(weights.values()) or 1
+    due_resources = []
+    for name, state in intraday_schedule_state.items():
+        if state["last_tick"] is not None:
+            hourly_share = INTRADAY_HOURLY_REQUEST_BUDGET * weights[name] / total_weight
+            state["credit"] = min(state["credit"] + hourly_share * (now - state["last_tick"]) / 3600, 1.5) # no bursts after idle periods
+        state["last_tick"] = now
+        if state["credit"] >= 1:
+            state["credit"] -= 1
+            due_resources.append(name)
+    for name, newest in get_intraday_data_limit_1d(date_str, due_resources).items():
+        state = intraday_schedule_state[name]
+        changed = newest is not None and newest != state["newest"]
+        state["change_rate"] = 0.7 * state["change_rate"] + 0.3 * (1.0 if changed else 0.0)
+        if newest is not None:
+            state["newest"] = newest
 
 # Max range is 30 days, records BR, SPO2 Intraday, skin temp and HRV - 4 queries
 def get_daily_data_limit_30d(start_date_str, end_date_str):
 
-    hrv_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/hrv/date/' + start_date_str + '/' + end_date_str + '.json')['hrv']
+    hrv_data_list = (request_data_from_fitbit('https://api.fitbit.com/1/user/-/hrv/date/' + start_date_str + '/' + end_date_str + '.json') or {}).get('hrv')
     if hrv_data_list != None:
         for data in hrv_data_list:
             log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
@@ -300,7 +1607,7 @@ def get_daily_data_limit_30d(start_date_str, end_date_str):
     else:
         logging.error("Recording failed HRV for date " + start_date_str + " to " + end_date_str)
 
-    br_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/br/date/' + start_date_str + '/' + end_date_str + '.json')["br"]
+    br_data_list = (request_data_from_fitbit('https://api.fitbit.com/1/user/-/br/date/' + start_date_str + '/' + end_date_str + '.json') or {}).get("br")
     if br_data_list != None:
         for data in br_data_list:
             log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
@@ -319,7 +1626,7 @@ def get_daily_data_limit_30d(start_date_str, end_date_str):
     else:
         logging.error("Recording failed : BR for date " + start_date_str + " to " + end_date_str)
 
-    skin_temp_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/temp/skin/date/' + start_date_str + '/' + end_date_str + '.json')["tempSkin"]
+    skin_temp_data_list = (request_data_from_fitbit('https://api.fitbit.com/1/user/-/temp/skin/date/' + start_date_str + '/' + end_date_str + '.json') or {}).get("tempSkin")
     if skin_temp_data_list != None:
         for temp_record in skin_temp_data_list:
             log_time = datetime.fromisoformat(temp_record["dateTime"] + "T" + "00:00:00")
@@ -340,92 +1647,84 @@ def get_daily_data_limit_30d(start_date_str, end_date_str):
 
     spo2_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/spo2/date/' + start_date_str + '/' + end_date_str + '/all.json')
     if spo2_data_list != None:
-        for days in spo2_data_list:
-            data = days["minutes"]
-            for record in data:
-                log_time = datetime.fromisoformat(record["minute"])
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                collected_records.append({
-                        "measurement":  "SPO2_Intraday",
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME
-                        },
-                        "fields": {
-                            "value": float(record["value"]),
-                        }
-                    })
+        record_points(parse_spo2_intraday, INTRADAY_RESOURCE_CATALOG["spo2"], spo2_data_list, start_date_str)
         logging.info("Recorded SPO2 intraday for date " + start_date_str + " to " + end_date_str)
     else:
         logging.error("Recording failed : SPO2 intraday for date " + start_date_str + " to " + end_date_str)
 
-# Only for sleep data - limit 100 days - 1 query
-def get_daily_data_limit_100d(start_date_str, end_date_str):
+# Converts sleep log records ( API or Takeout export ) to Sleep Summary and Sleep Levels points
+def sleep_records_to_points(sleep_data):
+    points = []
+    for record in sleep_data:
+        log_time = datetime.fromisoformat(record["startTime"])
+        utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
+        try:
+            minutesLight= record['levels']['summary']['light']['minutes']
+            minutesREM = record['levels']['summary']['rem']['minutes']
+            minutesDeep = record['levels']['summary']['deep']['minutes']
+        except:
+            minutesLight= record['levels']['summary']['asleep']['minutes']
+            minutesREM = record['levels']['summary']['restless']['minutes']
+            minutesDeep = 0
+
+        points.append({
+                "measurement":  "Sleep Summary",
+                "time": utc_time,
+                "tags": {
+                    "Device": DEVICENAME,
+                    "isMainSleep": record["isMainSleep"],
+                },
+                "fields": {
+                    'efficiency': record["efficiency"],
+                    'minutesAfterWakeup': record['minutesAfterWakeup'],
+                    'minutesAsleep': record['minutesAsleep'],
+                    'minutesToFallAsleep': record['minutesToFallAsleep'],
+                    'minutesInBed': record['timeInBed'],
+                    'minutesAwake': record['minutesAwake'],
+                    'minutesLight': minutesLight,
+                    'minutesREM': minutesREM,
+                    'minutesDeep': minutesDeep
+                }
+            })
 
-    sleep_data = request_data_from_fitbit('https://api.fitbit.com/1.2/user/-/sleep/date/' + start_date_str + '/' + end_date_str + '.json')["sleep"]
-    if sleep_data != None:
-        for record in sleep_data:
-            log_time = datetime.fromisoformat(record["startTime"])
+        sleep_level_mapping = {'wake': 3, 'rem': 2, 'light': 1, 'deep': 0, 'asleep': 1, 'restless': 2, 'awake': 3, 'unknown': 4}
+        for sleep_stage in record['levels']['data']:
+            log_time = datetime.fromisoformat(sleep_stage["dateTime"])
             utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            try:
-                minutesLight= record['levels']['summary']['light']['minutes']
-                minutesREM = record['levels']['summary']['rem']['minutes']
-                minutesDeep = record['levels']['summary']['deep']['minutes']
-            except:
-                minutesLight= record['levels']['summary']['asleep']['minutes']
-                minutesREM = record['levels']['summary']['restless']['minutes']
-                minutesDeep = 0
-
-            collected_records.append({
-                    "measurement":  "Sleep Summary",
+            points.append({
+                    "measurement":  "Sleep Levels",
                     "time": utc_time,
                     "tags": {
                         "Device": DEVICENAME,
                         "isMainSleep": record["isMainSleep"],
                     },
                     "fields": {
-                        'efficiency': record["efficiency"],
-                        'minutesAfterWakeup': record['minutesAfterWakeup'],
-                        'minutesAsleep': record['minutesAsleep'],
-                        'minutesToFallAsleep': record['minutesToFallAsleep'],
-                        'minutesInBed': record['timeInBed'],
-                        'minutesAwake': record['minutesAwake'],
-                        'minutesLight': minutesLight,
-                        'minutesREM': minutesREM,
-                        'minutesDeep': minutesDeep
+                        'level': sleep_level_mapping[sleep_stage["level"]],
+                        'duration_seconds': sleep_stage["seconds"]
                     }
                 })
+        wake_time = datetime.fromisoformat(record["endTime"])
+        utc_wake_time = LOCAL_TIMEZONE.localize(wake_time).astimezone(pytz.utc).isoformat()
+        points.append({
+                    "measurement":  "Sleep Levels",
+                    "time": utc_wake_time,
+                    "tags": {
+                        "Device": DEVICENAME,
+                        "isMainSleep": record["isMainSleep"],
+                    },
+                    "fields": {
+                        'level': sleep_level_mapping['wake'],
+                        'duration_seconds': None
+                    }
+                })
+    return points
 
-            sleep_level_mapping = {'wake': 3, 'rem': 2, 'light': 1, 'deep': 0, 'asleep': 1, 'restless': 2, 'awake': 3, 'unknown': 4}
-            for sleep_stage in record['levels']['data']:
-                log_time = datetime.fromisoformat(sleep_stage["dateTime"])
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                collected_records.append({
-                        "measurement":  "Sleep Levels",
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME,
-                            "isMainSleep": record["isMainSleep"],
-                        },
-                        "fields": {
-                            'level': sleep_level_mapping[sleep_stage["level"]],
-                            'duration_seconds': sleep_stage["seconds"]
-                        }
-                    })
-            wake_time = datetime.fromisoformat(record["endTime"])
-            utc_wake_time = LOCAL_TIMEZONE.localize(wake_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                        "measurement":  "Sleep Levels",
-                        "time": utc_wake_time,
-                        "tags": {
-                            "Device": DEVICENAME,
-                            "isMainSleep": record["isMainSleep"],
-                        },
-                        "fields": {
-                            'level': sleep_level_mapping['wake'],
-                            'duration_seconds': None
-                        }
-                    })
+# Only for sleep data - limit 100 days - 1 query
+def get_daily_data_limit_100d(start_date_str, end_date_str):
+
+    sleep_data = (request_data_from_fitbit('https://api.fitbit.com/1.2/user/-/sleep/date/' + start_date_str + '/' + end_date_str + '.json') or {}).get("sleep")
+    if sleep_data != None:
+        record_points(sleep_records_to_points, sleep_data)
         logging.info("Recorded Sleep data for date " + start_date_str + " to " + end_date_str)
     else:
         logging.error("Recording failed : Sleep data for date " + start_date_str + " to " + end_date_str)
@@ -434,7 +1733,7 @@ def get_daily_data_limit_100d(start_date_str, end_date_str):
 def get_daily_data_limit_365d(start_date_str, end_date_str):
     activity_minutes_list = ["minutesSedentary", "minutesLightlyActive", "minutesFairlyActive", "minutesVeryActive"]
     for activity_type in activity_minutes_list:
-        activity_minutes_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json')["activities-tracker-"+activity_type]
+        activity_minutes_data_list = (request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json') or {}).get("activities-tracker-"+activity_type)
         if activity_minutes_data_list != None:
             for data in activity_minutes_data_list:
                 log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
@@ -456,7 +1755,7 @@ def get_daily_data_limit_365d(start_date_str, end_date_str):
 
     activity_others_list = ["distance", "calories", "steps"]
     for activity_type in activity_others_list:
-        activity_others_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json')["activities-tracker-"+activity_type]
+        activity_others_data_list = (request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json') or {}).get("activities-tracker-"+activity_type)
         if activity_others_data_list != None:
             for data in activity_others_data_list:
                 log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
@@ -474,10 +1773,10 @@ def get_daily_data_limit_365d(start_date_str, end_date_str):
                     })
             logging.info("Recorded " + activity_name + " for date " + start_date_str + " to " + end_date_str)
         else:
-            logging.error("Recording failed : " + activity_name + " for date " + start_date_str + " to " + end_date_str)
+            logging.error("Recording failed : " + activity_type + " for date " + start_date_str + " to " + end_date_str)
 
 
-    HR_zones_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/heart/date/' + start_date_str + '/' + end_date_str + '.json')["activities-heart"]
+    HR_zones_data_list = (request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/heart/date/' + start_date_str + '/' + end_date_str + '.json') or {}).get("activities-heart")
     if HR_zones_data_list != None:
         for data in HR_zones_data_list:
             log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
@@ -489,7 +1788,7 @@ def get_daily_data_limit_365d(start_date_str, end_date_str):
             peak_mins = data["value"]["heartRateZones"][3].get("minutes", 0)
             
             # Log HR zone minutes
-            logging.info(f"HR Zone Minutes for {data['dateTime']}: Normal={normal_mins}, Fat Burn={fat_burn_mins}, Cardio={cardio_mins}, Peak={peak_mins}")
+            logging.debug(f"HR Zone Minutes for {data['dateTime']}: Normal={normal_mins}, Fat Burn={fat_burn_mins}, Cardio={cardio_mins}, Peak={peak_mins}")
             
             collected_records.append({
                     "measurement": "HR zones",
@@ -620,72 +1919,111 @@ def get_temperature_data(start_date_str, end_date_str):
     else:
         logging.error(f"Recording failed: Core Temperature for date {start_date_str} to {end_date_str}")
 
-def get_ecg_data(start_date_str, end_date_str):
-    """Fetches ECG readings"""
-    offset = 0
-    limit = 10
-    while True:
+# Walks a Fitbit list endpoint forward from the persisted cursor (startTime of the newest entry already stored)
+# cursor_name None ignores any stored cursor and walks from backfill_start_date_str
+def fetch_list_after_cursor(url, list_key, cursor_name, backfill_start_date_str, page_limit, max_pages=LIST_BACKFILL_MAX_PAGES, overlap=timedelta(0)):
+    """Entries newer than the stored cursor, or than backfill_start_date_str on the first run. With an overlap the read
+    starts that much before the stored cursor, so entries showing up late are picked up too ( callers dedupe )"""
+    cursor = current_state(cursor_name) if cursor_name else None
+    if cursor and overlap:
+        cursor = (datetime.fromisoformat(cursor[:19]) - overlap).strftime("%Y-%m-%dT%H:%M:%S")
+    cursor = cursor or backfill_start_date_str + "T00:00:00"
+    new_entries = []
+    page_cursor = cursor
+    for page in range(max_pages):
         params = {
-            'beforeDate': end_date_str,
-            'sort': 'desc',
-            'limit': limit,
-            'offset': offset
+            'afterDate': page_cursor[:19], # yyyy-MM-ddTHH:mm:ss
+            'sort': 'asc',
+            'limit': page_limit,
+            'offset': 0
         }
-
-        data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/ecg/list.json', params=params)
-
-        if not data or 'ecgReadings' not in data or not data['ecgReadings']:
+        data = request_data_from_fitbit(url, params=params)
+        if not data or not data.get(list_key):
             break
+        page_entries = [entry for entry in data[list_key] if entry.get('startTime', '') > cursor]
+        new_entries.extend(page_entries)
+        if len(data[list_key]) < page_limit:
+            break
+        # Keyset pagination : next page starts after the newest entry of this page
+        newest_start_time = data[list_key][-1].get('startTime', '')
+        if newest_start_time[:19] <= page_cursor[:19]:
+            break
+        page_cursor = newest_start_time
+    else:
+        logging.info(f"Reached {max_pages} pages for {list_key}, backfill continues on the next run")
+    return new_entries
+
+# Stores the raw waveform as one compressed binary file per reading : 1 typecode byte + little endian samples, zlib compressed
+def save_ecg_waveform(reading):
+    samples = reading['waveformSamples']
+    if all(isinstance(sample, int) for sample in samples):
+        typecode = 'h' if all(-32768 <= sample <= 32767 for sample in samples) else 'i' # ECG ADC values normally fit in 16 bits
+    else:
+        typecode = 'd'
+    sample_array = array(typecode, samples)
+    if sys.byteorder != 'little':
+        sample_array.byteswap()
+    relative_path = os.path.join(reading['startTime'][:10], reading['startTime'].replace(':', '-').replace('.', '-') + '.ecg.z')
+    file_path = os.path.join(ECG_WAVEFORM_PATH, relative_path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as file:
+        file.write(zlib.compress(typecode.encode() + sample_array.tobytes(), 6))
+    return relative_path
+
+# Reads back a waveform written by save_ecg_waveform, path as stored in the ECG waveformFile field
+def load_ecg_waveform(relative_path):
+    with open(os.path.join(ECG_WAVEFORM_PATH, relative_path), 'rb') as file:
+        raw = zlib.decompress(file.read())
+    sample_array = array(raw[:1].decode())
+    sample_array.frombytes(raw[1:])
+    if sys.byteorder != 'little':
+        sample_array.byteswap()
+    return sample_array
 
-        for reading in data['ecgReadings']:
-            try:
-                # Check if we have the required fields
-                if 'startTime' not in reading:
-                    logging.warning(f"ECG reading missing startTime: {reading}")
-                    continue
-
-                log_time = datetime.fromisoformat(reading['startTime'].replace('Z', ''))
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-
-                # Only process readings within our date range
-                reading_date = reading['startTime'].split('T')[0]
-                if reading_date < start_date_str:
-                    break
-
-                fields = {}
-                if 'averageHeartRate' in reading:
-                    fields['averageHeartRate'] = reading['averageHeartRate']
-                if 'leadNumber' in reading:
-                    fields['leadNumber'] = reading['leadNumber']
-                if 'samplingFrequencyHz' in reading:
-                    fields['samplingFrequencyHz'] = reading['samplingFrequencyHz']
-                if 'waveformSamples' in reading:
-                    fields['numberOfSamples'] = len(reading['waveformSamples'])
+def get_ecg_data(start_date_str, end_date_str):
+    """Fetches ECG readings newer than the last stored one"""
+    readings = fetch_list_after_cursor('https://api.fitbit.com/1/user/-/ecg/list.json', 'ecgReadings', 'ecg_cursor', ECG_BACKFILL_START_DATE or start_date_str, 10) # 10 is the max page size for ECG
 
-                collected_records.append({
-                    "measurement": "ECG",
-                    "time": utc_time,
-                    "tags": {
-                        "Device": DEVICENAME,
-                        "classification": reading.get('resultClassification', 'unknown')
-                    },
-                    "fields": fields
-                })
-            except Exception as e:
-                logging.error(f"Error processing ECG reading: {e}")
-                continue
+    for reading in readings:
+        try:
+            log_time = datetime.fromisoformat(reading['startTime'].replace('Z', ''))
+            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
 
-        # If we got fewer results than the limit, we've reached the end
-        if len(data['ecgReadings']) < limit:
-            break
+            fields = {}
+            if 'averageHeartRate' in reading:
+                fields['averageHeartRate'] = reading['averageHeartRate']
+            if 'leadNumber' in reading:
+                fields['leadNumber'] = reading['leadNumber']
+            if 'samplingFrequencyHz' in reading:
+                fields['samplingFrequencyHz'] = reading['samplingFrequencyHz']
+            if 'scalingFactor' in reading:
+                fields['scalingFactor'] = reading['scalingFactor']
+            if 'waveformSamples' in reading:
+                fields['numberOfSamples'] = len(reading['waveformSamples'])
+                if ECG_WAVEFORM_PATH and reading['waveformSamples']:
+                    try:
+                        fields['waveformFile'] = save_ecg_waveform(reading)
+                    except (OSError, OverflowError, TypeError) as e: # The summary point is still worth keeping
+                        logging.error(f"Could not store the ECG waveform of {reading['startTime']} : {e}")
 
-        offset += limit
-        time.sleep(1)  # Rate limiting precaution
+            collected_records.append({
+                "measurement": "ECG",
+                "time": utc_time,
+                "tags": {
+                    "Device": DEVICENAME,
+                    "classification": reading.get('resultClassification', 'unknown')
+                },
+                "fields": fields
+            })
+        except Exception as e:
+            logging.error(f"Error processing ECG reading: {e}")
+            continue
 
-    if collected_records:
-        logging.info(f"Recorded ECG data before date {end_date_str}")
+    if readings:
+        save_state_after_write('ecg_cursor', max(reading['startTime'] for reading in readings))
+        logging.info(f"Recorded {len(readings)} new ECG readings up to {pending_state['ecg_cursor']}")
     else:
-        logging.warning(f"No ECG data found for date range {start_date_str} to {end_date_str}")
+        logging.info("No new ECG readings since " + str(persisted_state.get('ecg_cursor')))
 
 def get_water_logs(start_date_str, end_date_str):
     """Fetches water consumption logs"""
@@ -884,83 +2222,84 @@ def get_activity_summary(date_str):
     except Exception as e:
         logging.error(f"Error fetching activity summary for {date_str}: {e}")
 
-def fetch_latest_activities(end_date_str):
-    """Fetches the last 50 activities including today's activities
-
-    Args:
-        end_date_str: Current date in YYYY-MM-DD format
-    """
-    tomorrow = (datetime.strptime(end_date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-
-    params = {
-        'beforeDate': tomorrow,
-        'sort': 'desc',
-        'limit': 50,
-        'offset': 0
+def activity_to_point(activity):
+    """Activities point for one entry of the activity log"""
+    starttime = datetime.fromisoformat(activity['startTime'].strip("Z"))
+    utc_time = starttime.astimezone(pytz.utc).isoformat()
+
+    # Create a single record per activity with all relevant metrics
+    fields = {
+        # Duration metrics
+        'duration_minutes': round(float(activity.get('duration', 0)) / (1000 * 60), 2),  # Convert ms to minutes
+        'active_duration_minutes': round(float(activity.get('activeDuration', 0)) / (1000 * 60), 2),
+
+        # Performance metrics
+        'average_heart_rate': activity.get('averageHeartRate', 0),
+        'calories': activity.get('calories', 0),
+        'steps': activity.get('steps', 0),
+        'distance_km': round(float(activity.get('distance', 0)), 3),
     }
 
-    logging.info(f"Fetching last 50 activities up through {end_date_str}")
-    recent_activities_data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/list.json', params=params)
-
-    if recent_activities_data and 'activities' in recent_activities_data:
-        activity_count = len(recent_activities_data['activities'])
-        logging.info(f"Retrieved {activity_count} activities")
-
-        for activity in recent_activities_data['activities']:
-            starttime = datetime.fromisoformat(activity['startTime'].strip("Z"))
-            utc_time = starttime.astimezone(pytz.utc).isoformat()
-
-            # Create a single record per activity with all relevant metrics
-            fields = {
-                # Duration metrics
-                'duration_minutes': round(float(activity.get('duration', 0)) / (1000 * 60), 2),  # Convert ms to minutes
-                'active_duration_minutes': round(float(activity.get('activeDuration', 0)) / (1000 * 60), 2),
-
-                # Performance metrics
-                'average_heart_rate': activity.get('averageHeartRate', 0),
-                'calories': activity.get('calories', 0),
-                'steps': activity.get('steps', 0),
-                'distance_km': round(float(activity.get('distance', 0)), 3),
-            }
-
-            # Add speed if available (converted to km/h)
-            if 'speed' in activity:
-                fields['speed_kmh'] = round(float(activity['speed']) * 3.6, 2)  # Convert m/s to km/h
-
-            # Add pace if available (in min/km)
-            if 'pace' in activity:
-                fields['pace_min_km'] = round(float(activity['pace']) / 60, 2)
-
-            # Add elevation data if available
-            if 'elevationGain' in activity:
-                fields['elevation_gain_meters'] = float(activity['elevationGain'])
-
-            # Heart rate zones as percentage of total active time
-            if 'heartRateZones' in activity:
-                total_zone_minutes = sum(zone.get('minutes', 0) for zone in activity['heartRateZones'])
-                if total_zone_minutes > 0:
-                    for zone in activity['heartRateZones']:
-                        zone_name = zone.get('name', '').lower().replace(' ', '_')
-                        fields[f'hr_zone_{zone_name}_pct'] = round((zone.get('minutes', 0) / total_zone_minutes) * 100, 1)
-
-            collected_records.append({
-                "measurement": "Activities",
-                "time": utc_time,
-                "tags": {
-                    "activity_name": activity.get('activityName', 'Unknown-Activity'),
-                    "device": DEVICENAME,
-                    "log_type": activity.get('logType', 'automatic'),  # Track if manually logged
-                    "activity_date": starttime.strftime("%Y-%m-%d")    # Add date as tag for easier daily queries
-                },
-                "fields": fields
-            })
+    # Add speed if available (converted to km/h)
+    if 'speed' in activity:
+        fields['speed_kmh'] = round(float(activity['speed']) * 3.6, 2)  # Convert m/s to km/h
+
+    # Add pace if available (in min/km)
+    if 'pace' in activity:
+        fields['pace_min_km'] = round(float(activity['pace']) / 60, 2)
+
+    # Add elevation data if available
+    if 'elevationGain' in activity:
+        fields['elevation_gain_meters'] = float(activity['elevationGain'])
+
+    # Heart rate zones as percentage of total active time
+    if 'heartRateZones' in activity:
+        total_zone_minutes = sum(zone.get('minutes', 0) for zone in activity['heartRateZones'])
+        if total_zone_minutes > 0:
+            for zone in activity['heartRateZones']:
+                zone_name = zone.get('name', '').lower().replace(' ', '_')
+                fields[f'hr_zone_{zone_name}_pct'] = round((zone.get('minutes', 0) / total_zone_minutes) * 100, 1)
+
+    return {
+        "measurement": "Activities",
+        "time": utc_time,
+        "tags": {
+            "activity_name": activity.get('activityName', 'Unknown-Activity'),
+            "device": DEVICENAME,
+            "log_type": activity.get('logType', 'automatic'),  # Track if manually logged
+            "activity_date": starttime.strftime("%Y-%m-%d")    # Add date as tag for easier daily queries
+        },
+        "fields": fields
+    }
 
-        if activity_count > 0:
-            first_activity_date = recent_activities_data['activities'][-1]['startTime'].split('T')[0]
-            last_activity_date = recent_activities_data['activities'][0]['startTime'].split('T')[0]
-            logging.info(f"Activities range from {first_activity_date} to {last_activity_date}")
+def get_activity_history(backfill_start_date_str, use_cursor=True, max_pages=LIST_BACKFILL_MAX_PAGES):
+    """Fetches logged activities newer than the last stored one minus ACTIVITIES_OVERLAP_DAYS, the first run starts at backfill_start_date_str.
+    Without use_cursor ( bulk mode ) it reads from backfill_start_date_str and leaves the live cursor alone"""
+    overlap = timedelta(days=ACTIVITIES_OVERLAP_DAYS)
+    activities = fetch_list_after_cursor('https://api.fitbit.com/1/user/-/activities/list.json', 'activities', 'activities_cursor' if use_cursor else None, backfill_start_date_str, 100, max_pages, overlap) # 100 is the max page size
+    if use_cursor:
+        # logId -> startTime of the activities inside the overlap window that are already written
+        recent_log_ids = dict(current_state('activities_recent_log_ids') or {})
+        activities = [activity for activity in activities if str(activity.get('logId')) not in recent_log_ids]
+
+    for activity in activities:
+        try:
+            collected_records.append(activity_to_point(activity))
+        except Exception as e:
+            logging.error(f"Error processing activity {activity.get('logId')}: {e}")
+            continue
+
+    if activities:
+        newest_activity = max(activities, key=lambda activity : activity['startTime'])
+        logging.info(f"Recorded {len(activities)} new activities up to {newest_activity['startTime']} ( logId {newest_activity.get('logId')} )")
+        if use_cursor:
+            cursor = max(newest_activity['startTime'], current_state('activities_cursor') or '')
+            window_start = (datetime.fromisoformat(cursor[:19]) - overlap).strftime("%Y-%m-%dT%H:%M:%S")
+            recent_log_ids.update({str(activity.get('logId')): activity['startTime'] for activity in activities})
+            save_state_after_write('activities_recent_log_ids', {log_id: start_time for log_id, start_time in recent_log_ids.items() if start_time[:19] >= window_start})
+            save_state_after_write('activities_cursor', cursor)
     else:
-        logging.warning(f"No activities found through {end_date_str}")
+        logging.info("No new activities since " + str(current_state('activities_cursor')))
 
 # Add these new functions after your existing functions but before the scheduling section
 
@@ -1047,74 +2386,594 @@ def get_lifetime_stats():
     else:
         logging.warning("No lifetime stats data found")
 
+# Same ActivitySummary points as get_activity_summary, field name -> activities time series resource
+ACTIVITY_SUMMARY_SERIES = {
+    "caloriesOut": "calories",
+    "activityCalories": "activityCalories",
+    "steps": "steps",
+    "floors": "floors",
+    "sedentaryMinutes": "minutesSedentary",
+    "lightlyActiveMinutes": "minutesLightlyActive",
+    "fairlyActiveMinutes": "minutesFairlyActive",
+    "veryActiveMinutes": "minutesVeryActive"
+}
+
+def get_activity_summary_range(start_date_str, end_date_str):
+    """Fetches activity summaries for a date range, one time series request per summary field"""
+    fields_by_date = {}
+    for field_name, resource in ACTIVITY_SUMMARY_SERIES.items():
+        series = (request_data_from_fitbit(f'https://api.fitbit.com/1/user/-/activities/{resource}/date/{start_date_str}/{end_date_str}.json') or {}).get("activities-" + resource)
+        if series is None: # leave the field out rather than overwriting it with 0
+            logging.error(f"Recording failed: Activity Summary {field_name} for date {start_date_str} to {end_date_str}")
+            continue
+        for entry in series:
+            fields_by_date.setdefault(entry["dateTime"], {})[field_name] = int(float(entry["value"]))
+    for date_str, fields in sorted(fields_by_date.items()):
+        collected_records.append({
+            "measurement": "ActivitySummary",
+            "time": local_time_to_utc_iso(datetime.fromisoformat(date_str + "T00:00:00")),
+            "tags": {
+                "Device": DEVICENAME
+            },
+            "fields": fields
+        })
+    logging.info(f"Recorded Activity Summary for date {start_date_str} to {end_date_str}")
+
+# Request coalescing : pending days are merged into the fewest range requests each endpoint allows,
+# the fetchers already split range responses back into per day points.
+# Longest date range one call of each fetcher may cover, None when unbounded. Single day fetchers are 1
+ENDPOINT_MAX_SPAN_DAYS = {
+    "get_intraday_data_limit_1d": 1,
+    "get_food_logs": 1,
+    "get_activity_summary": 1,
+    "get_daily_data_limit_30d": 30,
+    "get_cardio_score": 30,
+    "get_stress_score": 30,
+    "get_temperature_data": 30,
+    "get_sleep_score": 30,
+    "get_body_measurements": 31,
+    "get_daily_data_limit_100d": 100,
+    "get_daily_data_limit_365d": 365,
+    "get_activity_summary_range": 365,
+    "get_water_logs": 1095,
+    "get_daily_data_limit_none": None,
+}
+
+def date_range_list(start_date_str, end_date_str):
+    start = datetime.fromisoformat(start_date_str)
+    return [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((datetime.fromisoformat(end_date_str) - start).days + 1)]
+
+def plan_date_ranges(date_strs, max_span_days):
+    """Covers the dates with the fewest ( start, end ) ranges of at most max_span_days, gaps between dates are fetched along"""
+    ranges = []
+    for date_str in sorted(set(date_strs)):
+        if ranges and (max_span_days is None or (datetime.fromisoformat(date_str) - datetime.fromisoformat(ranges[-1][0])).days < max_span_days):
+            ranges[-1][1] = date_str
+        else:
+            ranges.append([date_str, date_str])
+    return [tuple(date_range) for date_range in ranges]
+
+def run_coalesced(fetch_function, date_strs):
+    """Calls fetch_function once per planned range, single day fetchers once per date"""
+    max_span_days = ENDPOINT_MAX_SPAN_DAYS[fetch_function.__name__]
+    for start_date_str, end_date_str in plan_date_ranges(date_strs, max_span_days):
+        if max_span_days == 1:
+            fetch_function(start_date_str)
+        else:
+            fetch_function(start_date_str, end_date_str)
+
+def get_activity_summaries(date_strs):
+    """Per day summaries for a few days, time series ranges once they need fewer requests"""
+    range_requests = len(plan_date_ranges(date_strs, ENDPOINT_MAX_SPAN_DAYS["get_activity_summary_range"])) * len(ACTIVITY_SUMMARY_SERIES)
+    if range_requests < len(set(date_strs)):
+        run_coalesced(get_activity_summary_range, date_strs)
+    else:
+        run_coalesced(get_activity_summary, date_strs)
+
+# %% [markdown]
+# ## Takeout export import ( bulk history without API calls )
+# Reads the "Global Export Data" json files and the health csv files of a Fitbit / Google Takeout export,
+# parses files in parallel worker processes and writes the same measurements and tags as the live fetchers.
+
+# %%
+def export_time_to_utc_iso(time_str):
+    """Export csv timestamps are ISO, either UTC ( with Z ) or local without offset"""
+    parsed_time = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
+    if parsed_time.tzinfo is None:
+        return local_time_to_utc_iso(parsed_time)
+    return parsed_time.astimezone(pytz.utc).isoformat()
+
+# Global Export Data timestamps are UTC in MM/DD/YY HH:MM:SS format
+def export_utc_time_to_epoch_seconds(time_str):
+    return calendar.timegm((2000 + int(time_str[6:8]), int(time_str[0:2]), int(time_str[3:5]), int(time_str[9:11]), int(time_str[12:14]), int(time_str[15:17])))
+
+def parse_takeout_heart_rate(entries):
+    batch = PointBatch("HeartRate_Intraday", {"Device": DEVICENAME}, value_typecode='q')
+    for entry in entries:
+        batch.append(export_utc_time_to_epoch_seconds(entry["dateTime"]), int(entry["value"]["bpm"]))
+    return [batch] if len(batch) else []
+
+def parse_takeout_steps(entries):
+    batch = PointBatch("Steps_Intraday", {"Device": DEVICENAME}, value_typecode='q')
+    for entry in entries:
+        batch.append(export_utc_time_to_epoch_seconds(entry["dateTime"]), int(entry["value"]))
+    return [batch] if len(batch) else []
+
+def parse_takeout_resting_heart_rate(entries):
+    return [{
+            "measurement": "RestingHR",
+            "time": local_time_to_utc_iso(datetime.strptime(entry["value"]["date"], "%m/%d/%y")),
+            "tags": {"Device": DEVICENAME},
+            "fields": {"value": entry["value"]["value"]}
+        } for entry in entries if entry["value"].get("value")]
+
+def parse_takeout_sleep(entries):
+    for record in entries:
+        record.setdefault("isMainSleep", record.get("mainSleep", False))
+    return sleep_records_to_points(entries)
+
+def parse_takeout_minute_spo2(rows):
+    return [{
+            "measurement": "SPO2_Intraday",
+            "time": export_time_to_utc_iso(row["timestamp"]),
+            "tags": {"Device": DEVICENAME},
+            "fields": {"value": float(row["value"])}
+        } for row in rows]
+
+def parse_takeout_daily_spo2(rows):
+    return [{
+            "measurement": "SPO2",
+            "time": local_time_to_utc_iso(datetime.fromisoformat(row["timestamp"][:10] + "T00:00:00")),
+            "tags": {"Device": DEVICENAME},
+            "fields": {"avg": float(row["average_value"]), "max": float(row["upper_bound"]), "min": float(row["lower_bound"])}
+        } for row in rows]
+
+def parse_takeout_daily_hrv(rows):
+    return [{
+            "measurement": "HRV",
+            "time": local_time_to_utc_iso(datetime.fromisoformat(row["timestamp"][:10] + "T00:00:00")),
+            "tags": {"Device": DEVICENAME},
+            "fields": {"dailyRmssd": float(row["rmssd"])}
+        } for row in rows]
+
+def parse_takeout_sleep_score(rows):
+    points = []
+    for row in rows:
+        wake_date = datetime.fromisoformat(row["timestamp"].replace("Z", "+00:00")).astimezone(LOCAL_TIMEZONE).strftime("%Y-%m-%d")
+        points.append({
+            "measurement": "SleepScore",
+            "time": local_time_to_utc_iso(datetime.fromisoformat(wake_date + "T00:00:00")),
+            "tags": {"Device": DEVICENAME},
+            "fields": {
+                'overall_score': int(row["overall_score"]),
+                'composition_score': int(row["composition_score"]),
+                'revitalization_score': int(row["revitalization_score"]),
+                'duration_score': int(row["duration_score"])
+            }
+        })
+    return points
+
+# ( file name pattern, parser, file format )
+TAKEOUT_FILE_PARSERS = [
+    (re.compile(r"^heart_rate-\d{4}-\d{2}-\d{2}\.json$"), parse_takeout_heart_rate, "json"),
+    (re.compile(r"^steps-\d{4}-\d{2}-\d{2}\.json$"), parse_takeout_steps, "json"),
+    (re.compile(r"^resting_heart_rate-\d{4}-\d{2}-\d{2}\.json$"), parse_takeout_resting_heart_rate, "json"),
+    (re.compile(r"^sleep-\d{4}-\d{2}-\d{2}\.json$"), parse_takeout_sleep, "json"),
+    (re.compile(r"^Minute SpO2 - .*\.csv$"), parse_takeout_minute_spo2, "csv"),
+    (re.compile(r"^Daily SpO2 - .*\.csv$"), parse_takeout_daily_spo2, "csv"),
+    (re.compile(r"^Daily Heart Rate Variability Summary - .*\.csv$"), parse_takeout_daily_hrv, "csv"),
+    (re.compile(r"^sleep_score\.csv$"), parse_takeout_sleep_score, "csv"),
+]
+
+def find_takeout_parser(file_name):
+    for pattern, parser, file_format in TAKEOUT_FILE_PARSERS:
+        if pattern.match(os.path.basename(file_name)):
+            return parser, file_format
+    return None, None
+
+# Runs in a worker process : reads one export file and returns its points
+def parse_takeout_file(file_name):
+    parser, file_format = find_takeout_parser(file_name)
+    try:
+        if zipfile.is_zipfile(TAKEOUT_IMPORT_PATH):
+            with zipfile.ZipFile(TAKEOUT_IMPORT_PATH) as archive:
+                raw_content = archive.read(file_name).decode("utf-8-sig")
+        else:
+            with open(file_name, "r", encoding="utf-8-sig") as file:
+                raw_content = file.read()
+        if file_format == "json":
+            return parser(json.loads(raw_content))
+        return parser(csv.DictReader(io.StringIO(raw_content)))
+    except (KeyError, ValueError, TypeError, OSError, EOFError, zipfile.BadZipFile) as err: # Bad content, unreadable or truncated file
+        logging.error("Skipping unreadable Takeout file " + file_name + " : " + str(err))
+        return []
+
+def list_takeout_files(import_path):
+    if zipfile.is_zipfile(import_path):
+        with zipfile.ZipFile(import_path) as archive:
+            file_names = archive.namelist()
+    else:
+        file_names = [os.path.join(root, name) for root, dirs, names in os.walk(import_path) for name in names]
+    return sorted(name for name in file_names if find_takeout_parser(name)[0] is not None)
+
+def import_takeout_export(import_path):
+    file_names = list_takeout_files(import_path)
+    logging.info("Importing " + str(len(file_names)) + " files from Takeout export " + import_path + " with " + str(TAKEOUT_IMPORT_WORKERS) + " workers")
+    imported_points = 0
+    pending_files = deque() # ( file name, future ), at most TAKEOUT_IMPORT_WINDOW parsed files held in memory
+    with fork_worker_pool(TAKEOUT_IMPORT_WORKERS) as executor:
+        for file_name in file_names + [None]:
+            if file_name is not None:
+                pending_files.append((file_name, executor.submit(parse_takeout_file, file_name)))
+            while pending_files and (len(pending_files) >= TAKEOUT_IMPORT_WINDOW or file_name is None):
+                done_file_name, parsed = pending_files.popleft()
+                try:
+                    points = parsed.result()
+                except Exception as err: # e.g. a worker died, the other files still get imported
+                    logging.error("Skipping Takeout file " + done_file_name + " : " + str(err))
+                    continue
+                if points:
+                    write_points_to_influxdb(points)
+                    imported_points += point_count(points)
+                logging.debug("Imported " + str(len(points)) + " points / batches from " + done_file_name)
+    flush_output_sinks()
+    logging.info("Success : Takeout import complete, " + str(imported_points) + " points written")
+
+if TAKEOUT_IMPORT_PATH:
+    import_takeout_export(TAKEOUT_IMPORT_PATH)
+    if PARQUET_ARCHIVE_PATH:
+        compact_archive_partitions()
+    sys.exit(0)
+
+# %% [markdown]
+# ## Fitbit Subscriptions webhook receiver
+# Fitbit posts a small notification ( collection and date ) whenever the user syncs new data. The receiver only queues it,
+# the main loop then runs the matching fetchers for that date, so fresh data arrives without polling.
+
+# %%
+subscription_notifications = queue.Queue()
+
+def fitbit_signature(body):
+    return base64.b64encode(hmac.new((client_secret + "&").encode(), body, hashlib.sha1).digest()).decode()
+
+class FitbitSubscriptionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Endpoint verification : 204 for the right code, 404 for anything else
+        verify_code = parse_qs(urlparse(self.path).query).get("verify", [None])[0]
+        self.send_response(204 if FITBIT_SUBSCRIBER_VERIFICATION_CODE and verify_code == FITBIT_SUBSCRIBER_VERIFICATION_CODE else 404)
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not hmac.compare_digest(self.headers.get("X-Fitbit-Signature", ""), fitbit_signature(body)):
+            logging.warning("Rejected subscription notification with an invalid signature")
+            self.send_response(404)
+            self.end_headers()
+            return
+        try:
+            for notification in json.loads(body):
+                subscription_notifications.put((notification["collectionType"], notification["date"]))
+            self.send_response(204) # Fitbit expects an answer within 5 seconds, fetching happens later
+        except (ValueError, KeyError, TypeError) as err:
+            logging.error("Malformed subscription notification : " + str(err))
+            self.send_response(400)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("Subscription receiver : " + format % args)
+
+# Fetchers run for a notification of each collection, for the notified date
+SUBSCRIPTION_FETCHERS = { # collection -> fetch for a list of notified dates
+    "activities": lambda date_strs : (get_intraday_data_for_dates(date_strs), get_activity_summaries(date_strs), get_activity_history(ACTIVITIES_BACKFILL_START_DATE or start_date_str)),
+    "body": lambda date_strs : run_coalesced(get_body_measurements, date_strs),
+    "foods": lambda date_strs : (run_coalesced(get_food_logs, date_strs), run_coalesced(get_water_logs, date_strs)),
+    "sleep": lambda date_strs : (run_coalesced(get_daily_data_limit_100d, date_strs), run_coalesced(get_sleep_score, date_strs)),
+}
+
+def start_subscription_receiver():
+    server = ThreadingHTTPServer(("0.0.0.0", FITBIT_SUBSCRIBER_PORT), FitbitSubscriptionHandler)
+    threading.Thread(target=server.serve_forever, name="subscription-receiver", daemon=True).start()
+    logging.info("Listening for Fitbit subscription notifications on port " + str(FITBIT_SUBSCRIBER_PORT))
+    return server
+
+# Registering an existing subscription again is harmless ( Fitbit answers 200 instead of 201 )
+def create_fitbit_subscriptions():
+    for collection in FITBIT_SUBSCRIPTION_COLLECTIONS:
+        try: # Goes through the regular request path for token refresh on 401, retries and back-off
+            if request_data_from_fitbit(f'https://api.fitbit.com/1/user/-/{collection}/apiSubscriptions/{FITBIT_SUBSCRIBER_ID}-{collection}.json', request_type="post") is None:
+                logging.warning("Unable to create Fitbit subscription for " + collection + ", server errors persisted")
+            else:
+                logging.info("Fitbit subscription active for " + collection)
+        except Exception as err: # e.g. 409 when the collection is subscribed under another subscriber id
+            logging.warning("Unable to create Fitbit subscription for " + collection + " : " + str(err))
+
+# Waits up to timeout seconds for notifications, then fetches each collection once for all its notified dates
+def process_subscription_notifications(timeout):
+    try:
+        pending = {subscription_notifications.get(timeout=timeout)}
+    except queue.Empty:
+        return
+    time.sleep(2) # notifications of one sync arrive together, collect them before fetching
+    while not subscription_notifications.empty():
+        pending.add(subscription_notifications.get_nowait())
+    dates_by_collection = {}
+    for collection, date_str in pending:
+        dates_by_collection.setdefault(collection, set()).add(date_str)
+    for collection, date_strs in sorted(dates_by_collection.items()):
+        date_strs = sorted(date_strs)
+        if collection in SUBSCRIPTION_FETCHERS:
+            logging.info("Subscription notification : fetching " + collection + " for " + ", ".join(date_strs))
+            run_job("subscription_" + collection, lambda : SUBSCRIPTION_FETCHERS[collection](date_strs))
+        else:
+            logging.warning("Ignoring subscription notification for " + collection + " on " + ", ".join(date_strs))
+
+def send_test_subscription_notification(receiver_url, collection_type, date_str):
+    """Local stand-in for Fitbit : posts a signed sample notification to the receiver, e.g. from an interactive cell"""
+    body = json.dumps([{"collectionType": collection_type, "date": date_str, "ownerId": "-", "ownerType": "user", "subscriptionId": FITBIT_SUBSCRIBER_ID + "-" + collection_type}]).encode()
+    response = requests.post(receiver_url, data=body, headers={"Content-Type": "application/json", "X-Fitbit-Signature": fitbit_signature(body)}, timeout=10)
+    return response.status_code
+
+# %% [markdown]
+# ## Scheduled jobs
+# Every job records its last successful run ( after its points are written ) in the state file,
+# so a restart only runs the jobs that are actually due instead of the full startup burst.
+
+# %%
+def working_date_list():
+    return date_range_list(start_date_str, end_date_str)
+
+# ( job name, interval in seconds, function )
+scheduled_jobs = [
+    ("intraday_today", 3 * 60, lambda : run_intraday_scheduler(end_date_str)), # Auto-refresh intraday resources within INTRADAY_HOURLY_REQUEST_BUDGET
+    ("intraday_previous_days", 3600, lambda : get_intraday_data_for_dates(working_date_list()[:-1])), # Refilling any missing data on previous day end of night due to fitbit sync delay ( see issue #10 )
+    ("battery_level", 20 * 60, get_battery_level), # Auto-refresh battery level
+    ("daily_30d", 3 * 3600, lambda : get_daily_data_limit_30d(start_date_str, end_date_str)),
+    ("sleep", 4 * 3600, lambda : get_daily_data_limit_100d(start_date_str, end_date_str)),
+    ("daily_365d", 6 * 3600, lambda : get_daily_data_limit_365d(start_date_str, end_date_str)),
+    ("spo2_daily", 6 * 3600, lambda : get_daily_data_limit_none(start_date_str, end_date_str)),
+    ("activities", 3600, lambda : get_activity_history(ACTIVITIES_BACKFILL_START_DATE or start_date_str)),
+    ("cardio_score", 6 * 3600, lambda : get_cardio_score(start_date_str, end_date_str)),
+    ("temperature", 6 * 3600, lambda : get_temperature_data(start_date_str, end_date_str)),
+    ("ecg", 3600, lambda : get_ecg_data(start_date_str, end_date_str)),
+    ("water_logs", 3600, lambda : get_water_logs(start_date_str, end_date_str)),
+    ("food_logs", 3600, lambda : run_coalesced(get_food_logs, working_date_list())),
+    ("body_measurements", 3600, lambda : get_body_measurements(start_date_str, end_date_str)),
+    ("exercise_goals", 3600, get_exercise_goals),
+    ("activity_summary", 86400, lambda : get_activity_summaries(working_date_list())),
+    ("lifetime_stats", 12 * 3600, get_lifetime_stats), # Lifetime stats don't change frequently
+]
+if PARQUET_ARCHIVE_PATH:
+    scheduled_jobs.append(("archive_compaction", 86400, compact_archive_partitions))
+if INFLUXDB_DOWNSAMPLING and downsampling_influxdb_client() is not None:
+    scheduled_jobs.append(("raw_retention", 86400, lambda : delete_expired_raw_points(downsampling_influxdb_client())))
+
+def parse_job_overrides(overrides):
+    """"name=number,name=number" -> {name: number}"""
+    return {name.strip(): float(value) for name, value in (item.split("=") for item in overrides.split(",") if item.strip())}
+
+# Polling jobs whose data the subscribed collections push, stretched to the safety poll while the receiver runs
+SUBSCRIPTION_POLLED_JOBS = {
+    "activities": ["activities", "activity_summary"],
+    "body": ["body_measurements"],
+    "foods": ["food_logs", "water_logs"],
+    "sleep": ["sleep"],
+}
+if FITBIT_SUBSCRIBER_PORT:
+    pushed_jobs = {job_name for collection in FITBIT_SUBSCRIPTION_COLLECTIONS for job_name in SUBSCRIPTION_POLLED_JOBS.get(collection, [])}
+    scheduled_jobs = [(job_name, max(interval_seconds, FITBIT_SUBSCRIPTION_SAFETY_POLL_SECONDS) if job_name in pushed_jobs else interval_seconds, job_function) for job_name, interval_seconds, job_function in scheduled_jobs]
+
+job_interval_overrides = parse_job_overrides(JOB_INTERVALS) # Explicit intervals win over the subscription stretch
+unknown_jobs = set(job_interval_overrides) - {job_name for job_name, interval_seconds, job_function in scheduled_jobs}
+if unknown_jobs:
+    raise ValueError("Unknown jobs in JOB_INTERVALS : " + ", ".join(sorted(unknown_jobs)))
+scheduled_jobs = [(job_name, int(job_interval_overrides.get(job_name, interval_seconds)), job_function) for job_name, interval_seconds, job_function in scheduled_jobs]
+
+jobs_pending_success = []
+
+def run_job(job_name, job_function):
+    first_new_record = len(collected_records)
+    job_started = time.time()
+    job_context = current_job.set(job_name)
+    try:
+        job_function()
+        jobs_pending_success.append(job_name)
+        for point in collected_records[first_new_record:]:
+            measurement_jobs[point.measurement if isinstance(point, PointBatch) else point["measurement"]] = job_name
+        logging.info("Job " + job_name + " finished", extra={"duration": round(time.time() - job_started, 3)})
+    except Exception as e:
+        logging.error("Job " + job_name + " failed : " + str(e), extra={"duration": round(time.time() - job_started, 3)})
+    finally:
+        current_job.reset(job_context)
+
+def seconds_since_job_success(job_name):
+    return time.time() - persisted_state.get("job_last_success", {}).get(job_name, 0)
+
+def job_is_due(job_name, interval_seconds):
+    return seconds_since_job_success(job_name) >= interval_seconds
+
+# Called once the points of the finished jobs are handed to the sinks
+def commit_job_successes():
+    flush_output_sinks() # Cursors and job successes only move once the points are written or spooled
+    commit_pending_state()
+    if jobs_pending_success:
+        job_last_success = dict(persisted_state.get("job_last_success", {}))
+        for job_name in jobs_pending_success:
+            job_last_success[job_name] = time.time()
+        save_state("job_last_success", job_last_success)
+        jobs_pending_success.clear()
+
+# %% [markdown]
+# ## Schedule quota simulator
+# Replays the job table for SIMULATE_SCHEDULE_HOURS against the hourly rate limit, without any API call. Requests are
+# spread over one per SIMULATED_REQUEST_SECONDS and a 429 stalls the loop like request_data_from_fitbit does, until the
+# next hour plus 300 seconds. Reports requests per clock hour, 429s, and how stale every measurement gets.
+
+# %%
+SIMULATED_REQUEST_SECONDS = 1
+SIMULATED_LOOP_SLEEP_SECONDS = 30 # The schedule loop sleeps this long between run_pending calls
+
+# Estimated requests per run, fractional costs accumulate across runs. Jobs not listed make no Fitbit calls
+JOB_REQUEST_COSTS = {
+    "intraday_today": INTRADAY_HOURLY_REQUEST_BUDGET * 3 * 60 / 3600, # the intraday scheduler spends its hourly budget
+    "intraday_previous_days": sum(1 if "range_url" in INTRADAY_RESOURCE_CATALOG[name] else auto_update_date_range for name in INTRADAY_RESOURCES),
+    "battery_level": 1,
+    "daily_30d": 4,
+    "sleep": 1,
+    "daily_365d": 8,
+    "spo2_daily": 1,
+    "activities": 1, # one page unless more than 100 new activities
+    "cardio_score": 1,
+    "temperature": 1,
+    "ecg": 1, # one page, more when many new readings arrived
+    "water_logs": 1,
+    "food_logs": auto_update_date_range + 1,
+    "body_measurements": 2,
+    "exercise_goals": 2,
+    "activity_summary": min(auto_update_date_range + 1, len(ACTIVITY_SUMMARY_SERIES)),
+    "lifetime_stats": 1,
+}
+JOB_REQUEST_COSTS.update(parse_job_overrides(SIMULATE_JOB_COSTS))
+
+JOB_MEASUREMENTS = {
+    "intraday_today": [INTRADAY_RESOURCE_CATALOG[name]["measurement"] for name in INTRADAY_RESOURCES],
+    "intraday_previous_days": [INTRADAY_RESOURCE_CATALOG[name]["measurement"] for name in INTRADAY_RESOURCES],
+    "battery_level": ["DeviceBatteryLevel"],
+    "daily_30d": ["HRV", "BreathingRate", "Skin Temperature Variation", "SPO2_Intraday"],
+    "sleep": ["Sleep Summary", "Sleep Levels"],
+    "daily_365d": ["Activity Minutes", "distance", "calories", "Total Steps", "HR zones", "RestingHR"],
+    "spo2_daily": ["SPO2"],
+    "activities": ["Activities"],
+    "cardio_score": ["CardioScore"],
+    "temperature": ["CoreTemperature"],
+    "ecg": ["ECG"],
+    "water_logs": ["WaterLog"],
+    "food_logs": ["NutritionSummary", "FoodLog"],
+    "body_measurements": ["BodyMeasurements", "BodyFat"],
+    "exercise_goals": ["ActivityGoals"],
+    "activity_summary": ["ActivitySummary"],
+    "lifetime_stats": ["LifetimeStats"],
+}
+
+def simulate_schedule(jobs, job_request_costs, duration_seconds, start_offset_seconds=0, rate_limit=FITBIT_RATE_LIMIT_PER_HOUR):
+    """Discrete event run of ( name, interval, function ) jobs from a cold start, start_offset_seconds past a full hour.
+    Returns requests per clock hour, the 429 count and each job's completion times"""
+    now = start_offset_seconds
+    end = start_offset_seconds + duration_seconds
+    hourly_requests = {}
+    rate_limited = 0
+    carried_cost = {job_name: 0.0 for job_name, interval_seconds, job_function in jobs}
+    completions = {job_name: [] for job_name, interval_seconds, job_function in jobs}
+    next_run = {job_name: now for job_name, interval_seconds, job_function in jobs} # startup runs every job
+    while now < end:
+        for job_name, interval_seconds, job_function in sorted(jobs, key=lambda job : next_run[job[0]]):
+            if next_run[job_name] > now:
+                continue
+            owed = carried_cost[job_name] + job_request_costs.get(job_name, 0)
+            carried_cost[job_name] = owed - int(owed)
+            for request in range(int(owed)):
+                hour = int(now // 3600)
+                if hourly_requests.get(hour, 0) >= rate_limit:
+                    rate_limited += 1
+                    now = (hour + 1) * 3600 + 300 # Fitbit-Rate-Limit-Reset + 300
+                    hour = int(now // 3600)
+                hourly_requests[hour] = hourly_requests.get(hour, 0) + 1
+                now += SIMULATED_REQUEST_SECONDS
+            completions[job_name].append(now)
+            next_run[job_name] = now + interval_seconds # schedule counts the interval from the end of a run
+        now += SIMULATED_LOOP_SLEEP_SECONDS
+    return {"hourly_requests": hourly_requests, "rate_limited": rate_limited, "completions": completions, "start": start_offset_seconds, "end": end}
+
+def measurement_staleness(refresh_times, start, end):
+    """Worst and time averaged age in seconds of a measurement refreshed at refresh_times, counted from its first refresh"""
+    if not refresh_times:
+        return None, None
+    edges = sorted(refresh_times) + [end]
+    gaps = [later - earlier for earlier, later in zip(edges, edges[1:])]
+    covered = edges[-1] - edges[0]
+    return max(gaps), (sum(gap * gap / 2 for gap in gaps) / covered if covered else 0)
+
+def report_schedule_simulation(jobs, job_request_costs, duration_seconds):
+    """Simulates the job table starting at four different minutes of the hour, logs the worst case as one record and returns it"""
+    results = [simulate_schedule(jobs, job_request_costs, duration_seconds, start_offset_seconds=minute * 60) for minute in (0, 15, 30, 45)]
+    worst = max(results, key=lambda result : (result["rate_limited"], max(result["hourly_requests"].values(), default=0)))
+    peak = max(worst["hourly_requests"].values(), default=0)
+    risky_hours = sum(1 for requests_in_hour in worst["hourly_requests"].values() if requests_in_hour > 0.9 * FITBIT_RATE_LIMIT_PER_HOUR)
+    report = [f"Schedule simulation over {duration_seconds / 3600:g} hours : peak {peak} / {FITBIT_RATE_LIMIT_PER_HOUR} requests per hour, "
+              f"{worst['rate_limited']} rate limited requests ( 429 ), {risky_hours} hours above 90% of the limit, worst start at minute {worst['start'] // 60}"]
+    for hour in sorted(worst["hourly_requests"]):
+        report.append(f"  hour {hour - worst['start'] // 3600:3d} : {worst['hourly_requests'][hour]:4d} requests")
+    refresh_times = {}
+    for job_name, completion_times in worst["completions"].items():
+        for measurement in JOB_MEASUREMENTS.get(job_name, []):
+            refresh_times.setdefault(measurement, []).extend(completion_times)
+    for measurement, completion_times in sorted(refresh_times.items()):
+        worst_age, mean_age = measurement_staleness(completion_times, worst["start"], worst["end"])
+        if worst_age is None:
+            report.append(f"  {measurement} : never refreshed")
+        else:
+            report.append(f"  {measurement} : refreshed {len(completion_times)} times, worst age {worst_age / 60:.0f} min, mean age {mean_age / 60:.0f} min")
+    worst["report"] = "\n".join(report)
+    logging.info(worst["report"]) # One record, so per call site rate limiting can't cut the report short
+    return worst
+
+if SIMULATE_SCHEDULE:
+    report_schedule_simulation(scheduled_jobs, JOB_REQUEST_COSTS, SIMULATE_SCHEDULE_HOURS * 3600)
+    sys.exit(0)
+
 # %% [markdown]
 # ## Call the functions one time as a startup update OR do switch to bulk update mode
 
 # %%
 if AUTO_DATE_RANGE:
-    date_list = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end_date - start_date).days + 1)]
-
-    if len(date_list) > 3:
+    if len(working_date_list()) > 3:
         logging.warn("Auto schedule update is not meant for more than 3 days at a time...")
-    for date_str in date_list:
-        get_intraday_data_limit_1d(date_str, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')]) # 2 queries x number of dates ( default 2)
-    get_daily_data_limit_30d(start_date_str, end_date_str) # 3 queries
-    get_daily_data_limit_100d(start_date_str, end_date_str) # 1 query
-    get_daily_data_limit_365d(start_date_str, end_date_str) # 8 queries
-    get_daily_data_limit_none(start_date_str, end_date_str) # 1 query
-    get_cardio_score(start_date_str, end_date_str) # 1 query
-    get_temperature_data(start_date_str, end_date_str) # 1 query
-    get_ecg_data(start_date_str, end_date_str) # 1 query
-    get_water_logs(start_date_str, end_date_str) # 1 query
-    get_food_logs(start_date_str) # 1 query
-    get_body_measurements(start_date_str, end_date_str) # 1 query
-    get_exercise_goals() # 1 query
-    # Get activity summaries for each day
-    for date in date_list:
-        get_activity_summary(date)
-    get_battery_level() # 1 query
-    fetch_latest_activities(end_date_str) # 1 query
-    get_lifetime_stats()
+    due_jobs = [job for job in scheduled_jobs if OFFLINE_MODE or job_is_due(job[0], job[1])] # Replay runs everything once
+    logging.info("Startup update : running " + str(len(due_jobs)) + " due jobs out of " + str(len(scheduled_jobs)))
+    for job_name, interval_seconds, job_function in due_jobs:
+        run_job(job_name, job_function)
     write_points_to_influxdb(collected_records)
     collected_records = []
+    commit_job_successes()
 else:
     # Do Bulk update----------------------------------------------------------------------------------------------------------------------------
-    schedule.every(1).hours.do(lambda : Get_New_Access_Token(client_id,client_secret)) # Auto-refresh tokens every 1 hour
-
-    date_list = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end_date - start_date).days + 1)]
-
-    def yield_dates_with_gap(date_list, gap):
-        start_index = -1*gap
-        while start_index < len(date_list)-1:
-            start_index  = start_index + gap
-            end_index = start_index+gap
-            if end_index > len(date_list) - 1:
-                end_index = len(date_list) - 1
-            if start_index > len(date_list) - 1:
-                break
-            yield (date_list[start_index],date_list[end_index])
+    date_list = date_range_list(start_date_str, end_date_str)
+    INTRADAY_BULK_CHUNK_DAYS = 30 # Intraday points are written after every chunk of this many days
 
     def do_bulk_update(funcname, start_date, end_date):
         global collected_records
         funcname(start_date, end_date)
-        schedule.run_pending()
-        write_points_to_influxdb(collected_records)
-        collected_records = []
+        if transform_executor is None:
+            write_points_to_influxdb(collected_records)
+            collected_records = []
+        else:
+            queue_collected_records()
+            drain_transforms(BULK_PIPELINE_DEPTH)
 
-    fetch_latest_activities(date_list[-1])
-    write_points_to_influxdb(collected_records)
-    do_bulk_update(get_daily_data_limit_none, date_list[0], date_list[-1])
-    for date_range in yield_dates_with_gap(date_list, 360):
-        do_bulk_update(get_daily_data_limit_365d, date_range[0], date_range[1])
-    for date_range in yield_dates_with_gap(date_list, 98):
-        do_bulk_update(get_daily_data_limit_100d, date_range[0], date_range[1])
-    for date_range in yield_dates_with_gap(date_list, 28):
-        do_bulk_update(get_daily_data_limit_30d, date_range[0], date_range[1])
-    for single_day in date_list:
-        do_bulk_update(get_intraday_data_limit_1d, single_day, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')])
+    # One call per range the endpoint allows, written after each call
+    def do_coalesced_bulk_update(funcname):
+        for date_range in plan_date_ranges(date_list, ENDPOINT_MAX_SPAN_DAYS[funcname.__name__]):
+            do_bulk_update(funcname, date_range[0], date_range[1])
 
+    get_activity_history(date_list[0], use_cursor=False, max_pages=sys.maxsize) # Whole range, every page
+    write_points_to_influxdb(collected_records)
+    collected_records = []
+    if BULK_TRANSFORM_WORKERS > 1:
+        transform_executor = fork_worker_pool(BULK_TRANSFORM_WORKERS)
+    do_coalesced_bulk_update(get_daily_data_limit_none)
+    do_coalesced_bulk_update(get_daily_data_limit_365d)
+    do_coalesced_bulk_update(get_daily_data_limit_100d)
+    do_coalesced_bulk_update(get_daily_data_limit_30d)
+    for date_range in plan_date_ranges(date_list, INTRADAY_BULK_CHUNK_DAYS):
+        do_bulk_update(get_intraday_data_for_dates, date_range_list(date_range[0], date_range[1]), INTRADAY_RESOURCES)
+    if transform_executor is not None:
+        drain_transforms(0)
+        transform_executor.shutdown()
+        transform_executor = None
+
+    flush_output_sinks()
+    if PARQUET_ARCHIVE_PATH:
+        compact_archive_partitions()
     logging.info("Success : Bulk update complete for " + start_date_str + " to " + end_date_str)
-    print("Bulk update complete!")
 
 # %% [markdown]
 # ## Schedule functions at specific intervals (Ongoing continuous update)
@@ -1123,28 +2982,22 @@ else:
 # Ongoing continuous update of data
 if SCHEDULE_AUTO_UPDATE:
 
-    schedule.every(1).hours.do(lambda : Get_New_Access_Token(client_id,client_secret)) # Auto-refresh tokens every 1 hour
-    schedule.every(3).minutes.do( lambda : get_intraday_data_limit_1d(end_date_str, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')] )) # Auto-refresh detailed HR and steps
-    schedule.every(1).hours.do( lambda : get_intraday_data_limit_1d((datetime.strptime(end_date_str, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d"), [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')] )) # Refilling any missing data on previous day end of night due to fitbit sync delay ( see issue #10 )
-    schedule.every(20).minutes.do(get_battery_level) # Auto-refresh battery level
-    schedule.every(3).hours.do(lambda : get_daily_data_limit_30d(start_date_str, end_date_str))
-    schedule.every(4).hours.do(lambda : get_daily_data_limit_100d(start_date_str, end_date_str))
-    schedule.every(6).hours.do( lambda : get_daily_data_limit_365d(start_date_str, end_date_str))
-    schedule.every(6).hours.do(lambda : get_daily_data_limit_none(start_date_str, end_date_str))
-    schedule.every(1).hours.do( lambda : fetch_latest_activities(end_date_str))
-    schedule.every(6).hours.do(lambda : get_cardio_score(start_date_str, end_date_str))
-    schedule.every(6).hours.do(lambda : get_temperature_data(start_date_str, end_date_str))
-    schedule.every(1).hours.do(lambda : get_ecg_data(start_date_str, end_date_str))
-    schedule.every(1).hours.do(lambda : get_water_logs(start_date_str, end_date_str))
-    schedule.every(1).hours.do(lambda : get_food_logs(start_date_str))
-    schedule.every(1).hours.do(lambda : get_body_measurements(start_date_str, end_date_str))
-    schedule.every(1).hours.do(lambda : get_exercise_goals())
-    schedule.every(1).days.do(lambda: get_activity_summary(end_date_str))
-    schedule.every(12).hours.do(get_lifetime_stats)  # Lifetime stats don't change frequently
+    for job_name, interval_seconds, job_function in scheduled_jobs:
+        job = schedule.every(interval_seconds).seconds.do(run_job, job_name, job_function)
+        # First run when the job falls due according to its last success, not a full interval after startup
+        seconds_until_due = min(interval_seconds, max(0, interval_seconds - seconds_since_job_success(job_name)))
+        job.next_run = datetime.now() + timedelta(seconds=seconds_until_due)
+    if FITBIT_SUBSCRIBER_PORT:
+        start_subscription_receiver()
+        create_fitbit_subscriptions()
     while True:
         schedule.run_pending()
         if len(collected_records) != 0:
             write_points_to_influxdb(collected_records)
             collected_records = []
-        time.sleep(30)
+        commit_job_successes()
+        if FITBIT_SUBSCRIBER_PORT:
+            process_subscription_notifications(30) # Sleeps like below, but wakes up to fetch notified data
+        else:
+            time.sleep(30)
         update_working_dates()
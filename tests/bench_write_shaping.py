@@ -0,0 +1,112 @@
+"""Write shaping benchmark : synthetic days of points written the old way ( one line per point in fetch order, nanosecond
+timestamps ) and shaped by points_to_line_protocol ( grouped by series, time sorted, second timestamps, one line per
+series and second ).
+
+    python tests/bench_write_shaping.py --days 7
+    python tests/bench_write_shaping.py --days 7 --influxdb-url http://localhost:8086 --influxdb-token ... --influxdb-org home
+
+Without an InfluxDB url it only measures the client side : serialization time and payload size. With one ( 2.x, needs
+influxdb-client ) it also writes both variants into scratch buckets, reports the write throughput and deletes them again.
+"""
+import argparse, gzip, os, sys, time
+from array import array
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from script_loader import load_from_script
+
+DEVICENAME = "Benchmark Watch"
+script = load_from_script(
+    ["PointBatch", "escape_line_protocol", "format_line_protocol_field", "line_protocol_series_key", "points_to_line_protocol", "line_protocol_batches", "point_count"],
+    array=array, datetime=datetime, pytz=pytz, INFLUX_WRITE_BATCH_LINES=5000)
+
+
+def benchmark_points(days):
+    """Interleaved daily, 15 minute and per second points like the fetchers collect them"""
+    points = []
+    first_day = datetime(2024, 1, 1, tzinfo=pytz.utc)
+    for day in range(days):
+        day_start = first_day + timedelta(days=day)
+        heart_rate = script.PointBatch("HeartRate_Intraday", {"Device": DEVICENAME}, value_typecode='q')
+        for second in range(86400):
+            heart_rate.append(int(day_start.timestamp()) + second, 55 + second % 60)
+        points.append(heart_rate)
+        for quarter in range(96):
+            for measurement_number in range(18):
+                points.append({
+                    "measurement": "Benchmark_" + str(measurement_number),
+                    "time": (day_start + timedelta(minutes=15 * quarter, microseconds=quarter)).isoformat(),
+                    "tags": {"Device": DEVICENAME},
+                    "fields": {"value": float(quarter * measurement_number), "count": quarter}
+                })
+    return points
+
+
+def unshaped_line_protocol(points):
+    """The write path before shaping : one line per point in fetch order, nanosecond timestamps"""
+    lines = []
+    for point in points:
+        if isinstance(point, script.PointBatch):
+            prefix = script.line_protocol_series_key(point.measurement, point.tags) + " " + script.escape_line_protocol(point.field) + "="
+            suffix = "i " if point.values.typecode == 'q' else " "
+            lines.extend(prefix + repr(value) + suffix + str(epoch_seconds * 1000000000) for epoch_seconds, value in zip(point.times, point.values))
+        else:
+            timestamp = datetime.fromisoformat(point["time"])
+            epoch_nanoseconds = int(timestamp.replace(microsecond=0).timestamp()) * 1000000000 + timestamp.microsecond * 1000
+            fields = ",".join(script.escape_line_protocol(key) + "=" + script.format_line_protocol_field(value) for key, value in point["fields"].items())
+            lines.append(script.line_protocol_series_key(point["measurement"], point["tags"]) + " " + fields + " " + str(epoch_nanoseconds))
+    return lines
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def measure_serialization(points):
+    results = {}
+    for mode, serialize in (("unshaped", unshaped_line_protocol), ("shaped", script.points_to_line_protocol)):
+        elapsed, lines = timed(serialize, points)
+        body = "\n".join(lines).encode()
+        results[mode] = lines
+        print(f"{mode:>9} : {elapsed * 1000:8.0f} ms to serialize, {len(lines):9d} lines, {len(body) / 1e6:7.1f} MB, {len(gzip.compress(body, 5)) / 1e6:6.2f} MB gzipped")
+    return results
+
+
+def measure_influxdb_writes(arguments, serialized):
+    from influxdb_client import InfluxDBClient
+    from influxdb_client.client.write_api import SYNCHRONOUS
+    from influxdb_client.domain.write_precision import WritePrecision
+    client = InfluxDBClient(url=arguments.influxdb_url, token=arguments.influxdb_token, org=arguments.influxdb_org, enable_gzip=True, timeout=600000)
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    for mode, precision, requests_lines in (("unshaped", WritePrecision.NS, [serialized["unshaped"]]), ("shaped", WritePrecision.S, script.line_protocol_batches(serialized["shaped"]))):
+        bucket = client.buckets_api().create_bucket(bucket_name="fitbit_benchmark_" + mode, org=arguments.influxdb_org)
+        try:
+            started = time.perf_counter()
+            for lines in requests_lines:
+                write_api.write(bucket=bucket.name, org=arguments.influxdb_org, record=lines, write_precision=precision)
+            elapsed = time.perf_counter() - started
+            print(f"{mode:>9} : {elapsed:8.2f} s to write, {len(requests_lines)} requests, {len(serialized[mode]) / elapsed:9.0f} lines per second")
+        finally:
+            client.buckets_api().delete_bucket(bucket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks InfluxDB write shaping on synthetic Fitbit data")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--influxdb-url", default="")
+    parser.add_argument("--influxdb-token", default="")
+    parser.add_argument("--influxdb-org", default="home")
+    arguments = parser.parse_args()
+    points = benchmark_points(arguments.days)
+    print(f"{script.point_count(points)} points over {arguments.days} days")
+    serialized = measure_serialization(points)
+    if arguments.influxdb_url:
+        measure_influxdb_writes(arguments, serialized)
@@ -0,0 +1,11 @@
+import sys
+
+import pytest
+
+from script_loader import MODULE_NAME, load_from_script
+
+
+@pytest.fixture
+def script():
+    yield load_from_script
+    sys.modules.pop(MODULE_NAME, None)
@@ -0,0 +1,20 @@
+import ast, os, sys, types
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Fitbit_Fetch.py")
+MODULE_NAME = "fitbit_fetch_under_test"
+
+
+# Fitbit_Fetch.py connects to Fitbit and InfluxDB when imported, so tests and benchmarks compile only the functions and
+# classes they need into a fresh module, with the globals those use supplied by the caller
+def load_from_script(names, **script_globals):
+    with open(SCRIPT_PATH) as file:
+        tree = ast.parse(file.read())
+    definitions = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names]
+    missing = set(names) - {node.name for node in definitions}
+    if missing:
+        raise LookupError("Not defined in Fitbit_Fetch.py : " + ", ".join(sorted(missing)))
+    module = types.ModuleType(MODULE_NAME)
+    sys.modules[MODULE_NAME] = module # Lets pickle find the classes
+    module.__dict__.update(script_globals)
+    exec(compile(ast.Module(body=definitions, type_ignores=[]), SCRIPT_PATH, "exec"), module.__dict__)
+    return module
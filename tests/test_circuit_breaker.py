@@ -0,0 +1,57 @@
+import logging, threading, time
+
+NAMES = ["circuit_is_open", "circuit_allows_request", "record_endpoint_success", "record_endpoint_failure"]
+
+
+def load_breakers(script):
+    return script(NAMES, logging=logging, threading=threading, time=time, circuit_breakers={}, circuit_breakers_lock=threading.Lock(),
+                  CIRCUIT_BREAKER_THRESHOLD=3, CIRCUIT_BREAKER_COOLDOWN_SECONDS=60, REQUEST_DEADLINE_SECONDS=900)
+
+
+def trip(breakers, endpoint):
+    for _ in range(breakers.CIRCUIT_BREAKER_THRESHOLD):
+        breakers.record_endpoint_failure(endpoint)
+
+
+def end_cool_down(breakers, endpoint):
+    breakers.circuit_breakers[endpoint]["open_until"] = time.time() - 1
+
+
+def test_open_breaker_skips_requests(script):
+    breakers = load_breakers(script)
+    breakers.record_endpoint_failure("/1/user/-/ecg/list.json")
+    assert breakers.circuit_allows_request("/1/user/-/ecg/list.json")
+    trip(breakers, "/1/user/-/ecg/list.json")
+    assert breakers.circuit_is_open("/1/user/-/ecg/list.json")
+    assert not breakers.circuit_allows_request("/1/user/-/ecg/list.json")
+
+
+def test_only_one_concurrent_caller_probes_a_half_open_breaker(script):
+    breakers = load_breakers(script)
+    trip(breakers, "/1/user/-/hrv/date/{date}.json")
+    end_cool_down(breakers, "/1/user/-/hrv/date/{date}.json")
+    start = threading.Barrier(32)
+    allowed = []
+    def caller():
+        start.wait()
+        allowed.append(breakers.circuit_allows_request("/1/user/-/hrv/date/{date}.json"))
+    threads = [threading.Thread(target=caller) for _ in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert allowed.count(True) == 1
+
+
+def test_probe_outcome_closes_or_reopens_the_breaker(script):
+    breakers = load_breakers(script)
+    trip(breakers, "/1/user/-/spo2/date/{date}.json")
+    end_cool_down(breakers, "/1/user/-/spo2/date/{date}.json")
+    assert breakers.circuit_allows_request("/1/user/-/spo2/date/{date}.json")
+    breakers.record_endpoint_failure("/1/user/-/spo2/date/{date}.json")
+    assert not breakers.circuit_allows_request("/1/user/-/spo2/date/{date}.json")
+
+    end_cool_down(breakers, "/1/user/-/spo2/date/{date}.json")
+    assert breakers.circuit_allows_request("/1/user/-/spo2/date/{date}.json")
+    breakers.record_endpoint_success("/1/user/-/spo2/date/{date}.json")
+    assert all(breakers.circuit_allows_request("/1/user/-/spo2/date/{date}.json") for _ in range(3))
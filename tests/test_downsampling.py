@@ -0,0 +1,105 @@
+import hashlib, logging, re
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+import pytz
+
+
+class InfluxDBClient2:
+    """Stand-in for influxdb_client.InfluxDBClient recording rollup queries and deletes in call order"""
+    def __init__(self, oldest=None):
+        self.oldest = oldest
+        self.calls = []
+
+    def query_api(self):
+        client = self
+        class QueryApi:
+            def query(self, flux, org=None):
+                if flux.endswith("|> first()"):
+                    return [SimpleNamespace(records=[SimpleNamespace(get_time=lambda : client.oldest)])] if client.oldest else []
+                client.calls.append(("rollup", flux))
+                return []
+        return QueryApi()
+
+    def delete_api(self):
+        client = self
+        class DeleteApi:
+            def delete(self, start, stop, predicate, bucket=None, org=None):
+                client.calls.append(("delete", start, stop, predicate))
+        return DeleteApi()
+
+
+class InfluxDBClient1:
+    def __init__(self, oldest=None):
+        self.oldest = oldest
+        self.calls = []
+
+    def query(self, statement, epoch=None):
+        if statement.endswith("ORDER BY time ASC LIMIT 1"):
+            return SimpleNamespace(get_points=lambda : [{"time": int(self.oldest.timestamp())}] if self.oldest else [])
+        self.calls.append(statement)
+
+
+RULES = {
+    "HeartRate_Intraday": {"raw_retention_days": 30, "rollups": [("1m", ["mean", "max"]), ("1h", ["mean"])]},
+    "Steps_Intraday": {"raw_retention_days": 0, "rollups": [("1h", ["sum"])]},
+}
+NOW = datetime(2024, 6, 15, 13, 47, 12, tzinfo=pytz.utc).timestamp()
+OLDEST = datetime(2024, 5, 14, 21, 3, 40, tzinfo=pytz.utc) # Three chunks up to the 2024-05-16T13:00:00Z cutoff
+
+
+def load_downsampling(script):
+    return script(
+        ["duration_seconds", "downsampling_flux_pipeline", "downsampling_select_into", "influx_time", "raw_retention_cutoff", "oldest_raw_point_epoch",
+         "raw_rollup_chunks", "delete_expired_raw_points"],
+        datetime=datetime, timedelta=timedelta, pytz=pytz, time=__import__("time"), logging=logging, hashlib=hashlib, re=re,
+        InfluxDBClient2=InfluxDBClient2, DOWNSAMPLING_RULES=RULES, INFLUXDB_BUCKET="health_data", INFLUXDB_ROLLUP_BUCKET="health_data_rollup",
+        INFLUXDB_ORG="home", INFLUXDB_DATABASE="fitbit", INFLUXDB_ROLLUP_RETENTION_POLICY="fitbit_rollup", RAW_ROLLUP_CHUNK_SECONDS=86400)
+
+
+def test_cutoff_is_aligned_to_the_longest_window(script):
+    downsampling = load_downsampling(script)
+    assert downsampling.influx_time(downsampling.raw_retention_cutoff(RULES["HeartRate_Intraday"], NOW)) == "2024-05-16T13:00:00Z"
+
+
+def test_v2_rolls_up_and_deletes_a_day_at_a_time_up_to_the_cutoff(script):
+    downsampling = load_downsampling(script)
+    client = InfluxDBClient2(OLDEST)
+    downsampling.delete_expired_raw_points(client, now_epoch=NOW)
+    assert [call[0] for call in client.calls] == ["rollup", "rollup", "delete"] * 3
+    ranges = ["range(start: 2024-05-14T00:00:00Z, stop: 2024-05-15T00:00:00Z)", "range(start: 2024-05-15T00:00:00Z, stop: 2024-05-16T00:00:00Z)",
+              "range(start: 2024-05-16T00:00:00Z, stop: 2024-05-16T13:00:00Z)"]
+    for chunk, flux_range in enumerate(ranges):
+        for kind, flux in client.calls[3 * chunk:3 * chunk + 2]:
+            assert flux_range in flux
+            assert 'to(bucket: "health_data_rollup"' in flux
+    assert client.calls[-1] == ("delete", "1970-01-01T00:00:00Z", "2024-05-16T12:59:59Z", '_measurement="HeartRate_Intraday"')
+
+
+def test_v1_rolls_up_the_same_chunks_before_deleting(script):
+    downsampling = load_downsampling(script)
+    client = InfluxDBClient1(OLDEST)
+    downsampling.delete_expired_raw_points(client, now_epoch=NOW)
+    assert len(client.calls) == 9
+    assert all(statement.startswith('SELECT ') and "WHERE time >= '2024-05-16T00:00:00Z' AND time < '2024-05-16T13:00:00Z'" in statement for statement in client.calls[6:8])
+    assert client.calls[8] == "DELETE FROM \"HeartRate_Intraday\" WHERE time < '2024-05-16T13:00:00Z'"
+
+
+def test_nothing_to_do_without_raw_points_before_the_cutoff(script):
+    downsampling = load_downsampling(script)
+    client = InfluxDBClient2()
+    downsampling.delete_expired_raw_points(client, now_epoch=NOW)
+    assert client.calls == []
+
+
+def test_failed_rollup_deletes_nothing(script):
+    downsampling = load_downsampling(script)
+    client = InfluxDBClient2(OLDEST)
+    def failing_query(flux, org=None):
+        raise RuntimeError("rollup failed")
+    client.query_api = lambda : type("QueryApi", (), {"query": staticmethod(failing_query)})()
+    downsampling.oldest_raw_point_epoch = lambda client, measurement, cutoff_epoch : int(OLDEST.timestamp())
+    with pytest.raises(RuntimeError):
+        downsampling.delete_expired_raw_points(client, now_epoch=NOW)
+    assert client.calls == []
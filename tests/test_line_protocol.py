@@ -0,0 +1,54 @@
+from array import array
+from datetime import datetime
+
+import pytz
+
+NAMES = ["PointBatch", "escape_line_protocol", "format_line_protocol_field", "line_protocol_series_key", "points_to_line_protocol", "line_protocol_batches"]
+
+
+def load_line_protocol(script):
+    return script(NAMES, array=array, datetime=datetime, pytz=pytz, INFLUX_WRITE_BATCH_LINES=2)
+
+
+def test_batches_of_one_series_come_out_sorted_across_days(script):
+    line_protocol = load_line_protocol(script)
+    second_day = line_protocol.PointBatch("HeartRate_Intraday", {"Device": "Pixel Watch 3"}, value_typecode='q')
+    second_day.append(86400, 61)
+    first_day = line_protocol.PointBatch("HeartRate_Intraday", {"Device": "Pixel Watch 3"}, value_typecode='q')
+    first_day.append(0, 60)
+    first_day.append(1, 62)
+    assert line_protocol.points_to_line_protocol([second_day, first_day]) == [
+        "HeartRate_Intraday,Device=Pixel\\ Watch\\ 3 value=60i 0",
+        "HeartRate_Intraday,Device=Pixel\\ Watch\\ 3 value=62i 1",
+        "HeartRate_Intraday,Device=Pixel\\ Watch\\ 3 value=61i 86400",
+    ]
+
+
+def test_points_of_one_series_and_second_are_merged(script):
+    line_protocol = load_line_protocol(script)
+    points = [
+        {"measurement": "Activity Minutes", "time": "2024-01-01T00:00:00+00:00", "tags": {"Device": "x"}, "fields": {"sedentary": 600}},
+        {"measurement": "Activity Minutes", "time": "2024-01-01T00:00:00+00:00", "tags": {"Device": "x"}, "fields": {"lightly_active": 200}},
+    ]
+    assert line_protocol.points_to_line_protocol(points) == ["Activity\\ Minutes,Device=x sedentary=600i,lightly_active=200i 1704067200"]
+
+
+def test_sub_second_points_collapse_and_the_last_one_wins(script):
+    line_protocol = load_line_protocol(script)
+    points = [
+        {"measurement": "SPO2", "time": "2024-01-01T00:00:00.100000+00:00", "tags": {}, "fields": {"value": 95.0}},
+        {"measurement": "SPO2", "time": "2024-01-01T00:00:00.900000+00:00", "tags": {}, "fields": {"value": 97.0}},
+    ]
+    assert line_protocol.points_to_line_protocol(points) == ["SPO2 value=97.0 1704067200"]
+
+
+def test_overlapping_batches_fall_back_to_merging(script):
+    line_protocol = load_line_protocol(script)
+    earlier = line_protocol.PointBatch("Steps_Intraday", {}, value_typecode='q')
+    for epoch_seconds in (0, 60, 120):
+        earlier.append(epoch_seconds, 1)
+    refetched = line_protocol.PointBatch("Steps_Intraday", {}, value_typecode='q')
+    refetched.append(60, 5)
+    lines = line_protocol.points_to_line_protocol([earlier, refetched])
+    assert lines == ["Steps_Intraday value=1i 0", "Steps_Intraday value=5i 60", "Steps_Intraday value=1i 120"]
+    assert line_protocol.line_protocol_batches(lines) == [lines[:2], lines[2:]]
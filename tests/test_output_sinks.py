@@ -0,0 +1,65 @@
+import abc, gzip, json, logging, os, queue, random, sqlite3, threading, time
+from array import array
+from datetime import datetime
+
+import pytest
+import pytz
+
+
+@pytest.fixture
+def sinks(script, tmp_path):
+    return script(
+        ["PointBatch", "point_count", "points_to_spool_entries", "spool_entries_to_points", "backoff_seconds", "OutputSink", "SQLiteSink"],
+        abc=abc, array=array, datetime=datetime, pytz=pytz, gzip=gzip, json=json, logging=logging, os=os, queue=queue, random=random,
+        sqlite3=sqlite3, threading=threading, time=time, SQLITE_SINK_PATH=str(tmp_path / "points.sqlite"), SINK_SPOOL_PATH=str(tmp_path / "spool"),
+        SINK_BATCH_SIZE=5000, SINK_QUEUE_SIZE=10, SINK_WORKERS=1, SINK_ENQUEUE_TIMEOUT=1, SINK_WRITE_RETRIES=1,
+        RETRY_BACKOFF_BASE_SECONDS=0, RETRY_BACKOFF_MAX_SECONDS=0)
+
+
+def sample_points(sinks):
+    heart_rate = sinks.PointBatch("HeartRate_Intraday", {"Device": "Pixel Watch 3"}, value_typecode='q')
+    heart_rate.append(1704067200, 61)
+    heart_rate.append(1704067201, 63)
+    return [heart_rate, {"measurement": "RestingHR", "time": "2024-01-01T00:00:00+00:00", "tags": {"Device": "Pixel Watch 3"}, "fields": {"value": 52}}]
+
+
+def stored_rows(sinks):
+    with sqlite3.connect(sinks.SQLITE_SINK_PATH) as connection:
+        return connection.execute("SELECT measurement, time, tags, fields FROM points ORDER BY measurement, time").fetchall()
+
+
+def test_output_sink_requires_write(sinks):
+    with pytest.raises(TypeError):
+        sinks.OutputSink()
+
+
+def test_sqlite_sink_through_submit_and_flush(sinks):
+    sink = sinks.SQLiteSink()
+    sink.submit(sample_points(sinks))
+    sink.flush()
+    assert stored_rows(sinks) == [
+        ("HeartRate_Intraday", "2024-01-01T00:00:00+00:00", '{"Device": "Pixel Watch 3"}', '{"value": 61}'),
+        ("HeartRate_Intraday", "2024-01-01T00:00:01+00:00", '{"Device": "Pixel Watch 3"}', '{"value": 63}'),
+        ("RestingHR", "2024-01-01T00:00:00+00:00", '{"Device": "Pixel Watch 3"}', '{"value": 52}'),
+    ]
+
+
+def test_failed_writes_are_spooled_and_resent(sinks):
+    class FlakySQLiteSink(sinks.SQLiteSink):
+        available = False
+        def write(self, points):
+            if not self.available:
+                raise sqlite3.OperationalError("database is locked")
+            super().write(points)
+
+    sink = FlakySQLiteSink()
+    sink.submit(sample_points(sinks))
+    sink.flush()
+    assert stored_rows(sinks) == []
+    assert len(os.listdir(sink.spool_directory())) == 1
+
+    sink.available = True
+    sink.submit([{"measurement": "BodyFat", "time": "2024-01-02T00:00:00+00:00", "tags": {}, "fields": {"value": 20.5}}])
+    sink.flush()
+    assert [row[0] for row in stored_rows(sinks)] == ["BodyFat", "HeartRate_Intraday", "HeartRate_Intraday", "RestingHR"]
+    assert os.listdir(sink.spool_directory()) == []
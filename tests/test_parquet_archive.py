@@ -0,0 +1,98 @@
+import json, logging, os, tempfile, time, types
+from array import array
+from datetime import datetime
+
+import pytest
+import pytz
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.compute, pyarrow.parquet
+
+NAMES = ["PointBatch", "write_json_atomically", "archive_partition_path", "infer_archive_column_type", "points_to_arrow_table", "with_archive_tags",
+         "archive_tag_names", "concat_archive_tables", "dedupe_archive_table", "read_archive_partition", "point_batch_to_arrow_tables", "write_points_to_archive", "read_compaction_manifest", "archive_part_files", "finish_interrupted_compaction",
+         "compact_archive_partitions", "read_archive"]
+
+
+def load_archive(script, archive_path, os_module=os):
+    return script(NAMES, array=array, datetime=datetime, pytz=pytz, json=json, logging=logging, os=os_module, tempfile=tempfile, time=time,
+                  pyarrow=pyarrow, PARQUET_ARCHIVE_PATH=str(archive_path), ARCHIVE_COMPACTION_MANIFEST=".compaction.json",
+                  ARCHIVE_TAGS_METADATA_KEY=b"fitbit_tags")
+
+
+def write_two_parts(archive):
+    for hour, value in ((1, 60), (2, 62)):
+        archive.write_points_to_archive([{"measurement": "RestingHR", "time": f"2024-01-01T0{hour}:00:00+00:00", "tags": {"Device": "x"}, "fields": {"value": value}}])
+
+
+def archived_values(archive):
+    return [value for date_str, table in archive.read_archive("RestingHR", "2024-01-01", "2024-01-01") for value in table.column("value").to_pylist()]
+
+
+def test_parts_appear_only_once_complete(script, tmp_path):
+    archive = load_archive(script, tmp_path)
+    write_two_parts(archive)
+    directory = archive.archive_partition_path("RestingHR", "2024-01-01")
+    assert all(name.startswith("part-") and name.endswith(".parquet") for name in os.listdir(directory))
+    assert archived_values(archive) == [60, 62]
+
+
+def test_crash_after_the_swap_neither_loses_nor_duplicates_points(script, tmp_path):
+    crashing_os = types.SimpleNamespace(**{name: getattr(os, name) for name in dir(os) if not name.startswith("__")})
+    def crash(path):
+        raise KeyboardInterrupt("crash while removing " + path)
+    crashing_os.remove = crash
+    write_two_parts(load_archive(script, tmp_path))
+
+    with pytest.raises(KeyboardInterrupt):
+        load_archive(script, tmp_path, crashing_os).compact_archive_partitions()
+    archive = load_archive(script, tmp_path)
+    directory = archive.archive_partition_path("RestingHR", "2024-01-01")
+    assert len([name for name in os.listdir(directory) if name.endswith(".parquet")]) == 3 # compacted output plus both parts
+    assert archived_values(archive) == [60, 62]
+
+    archive.compact_archive_partitions()
+    remaining = os.listdir(directory)
+    assert len(remaining) == 1 and remaining[0].startswith("compacted-")
+    assert archived_values(archive) == [60, 62]
+
+
+def heart_rate_hour(archive, offset):
+    batch = archive.PointBatch("HeartRate_Intraday", {"Device": "x"}, value_typecode='q')
+    for second in range(3600):
+        batch.append(1704067200 + second, 60 + offset)
+    return batch
+
+
+def test_refetched_data_is_stored_once(script, tmp_path):
+    archive = load_archive(script, tmp_path)
+    for fetch in range(5):
+        archive.write_points_to_archive([heart_rate_hour(archive, fetch)])
+    tables = [table for date_str, table in archive.read_archive("HeartRate_Intraday", "2024-01-01", "2024-01-01")]
+    assert tables[0].num_rows == 3600 and set(tables[0].column("value").to_pylist()) == {64} # the last fetch wins
+    archive.compact_archive_partitions()
+    directory = archive.archive_partition_path("HeartRate_Intraday", "2024-01-01")
+    compacted = pyarrow.parquet.read_table(os.path.join(directory, os.listdir(directory)[0]))
+    assert compacted.num_rows == 3600 and set(compacted.column("value").to_pylist()) == {64}
+
+
+def test_points_of_one_time_and_tags_are_merged_field_by_field(script, tmp_path):
+    archive = load_archive(script, tmp_path)
+    archive.write_points_to_archive([
+        {"measurement": "Activity Minutes", "time": "2024-01-01T00:00:00+00:00", "tags": {"Device": "x"}, "fields": {"sedentary": 600}},
+        {"measurement": "Activity Minutes", "time": "2024-01-01T00:00:00+00:00", "tags": {"Device": "x"}, "fields": {"lightly_active": 200}},
+        {"measurement": "Activity Minutes", "time": "2024-01-01T00:00:00+00:00", "tags": {"Device": "y"}, "fields": {"sedentary": 1}},
+    ])
+    table = next(archive.read_archive("Activity Minutes", "2024-01-01", "2024-01-01"))[1]
+    assert sorted(table.to_pylist(), key=lambda row : row["Device"]) == [
+        {"time": datetime(2024, 1, 1, tzinfo=pytz.utc), "Device": "x", "lightly_active": 200, "sedentary": 600},
+        {"time": datetime(2024, 1, 1, tzinfo=pytz.utc), "Device": "y", "lightly_active": None, "sedentary": 1},
+    ]
+
+
+def test_all_none_fields_merge_with_typed_parts(script, tmp_path):
+    archive = load_archive(script, tmp_path)
+    archive.write_points_to_archive([{"measurement": "StressScore", "time": "2024-01-01T00:00:00+00:00", "tags": {}, "fields": {"value": None}}])
+    archive.write_points_to_archive([{"measurement": "StressScore", "time": "2024-01-01T01:00:00+00:00", "tags": {}, "fields": {"value": 70}}])
+    assert next(archive.read_archive("StressScore", "2024-01-01", "2024-01-01"))[1].column("value").to_pylist() == [None, 70]
+    archive.compact_archive_partitions()
+    assert next(archive.read_archive("StressScore", "2024-01-01", "2024-01-01"))[1].column("value").type == pyarrow.int64()
@@ -0,0 +1,73 @@
+import base64, hashlib, hmac, json, logging, queue, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+from requests.exceptions import ConnectionError, Timeout
+
+
+@pytest.fixture
+def receiver(script):
+    subscriptions = script(
+        ["fitbit_signature", "FitbitSubscriptionHandler", "send_test_subscription_notification"],
+        base64=base64, hmac=hmac, hashlib=hashlib, json=json, logging=logging, requests=requests, BaseHTTPRequestHandler=BaseHTTPRequestHandler,
+        parse_qs=parse_qs, urlparse=urlparse, client_secret="secret", subscription_notifications=queue.Queue(),
+        FITBIT_SUBSCRIBER_VERIFICATION_CODE="verify-me", FITBIT_SUBSCRIBER_ID="fitbit-fetch")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), subscriptions.FitbitSubscriptionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield subscriptions, "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+    server.shutdown()
+
+
+def test_stand_in_notification_is_accepted_and_queued(receiver):
+    subscriptions, url = receiver
+    assert subscriptions.send_test_subscription_notification(url, "sleep", "2024-01-02") == 204
+    assert subscriptions.subscription_notifications.get_nowait() == ("sleep", "2024-01-02")
+
+
+def test_notification_with_a_wrong_signature_is_rejected(receiver):
+    subscriptions, url = receiver
+    response = requests.post(url, data=b'[{"collectionType": "sleep", "date": "2024-01-02"}]', headers={"X-Fitbit-Signature": "forged"}, timeout=10)
+    assert response.status_code == 404
+    assert subscriptions.subscription_notifications.empty()
+
+
+def test_subscriber_verification(receiver):
+    subscriptions, url = receiver
+    assert requests.get(url + "?verify=verify-me", timeout=10).status_code == 204
+    assert requests.get(url + "?verify=wrong", timeout=10).status_code == 404
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = json.dumps(body)
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+def test_subscription_post_refreshes_an_expired_token(script):
+    posts = []
+    def post(url, headers, params, data, timeout):
+        posts.append(headers["Authorization"])
+        return FakeResponse(401 if headers["Authorization"] == "Bearer expired" else 201, {"collectionType": "sleep"})
+    fake_requests = type("FakeRequests", (), {"post": staticmethod(post)})
+    def refresh(client_id, client_secret, rejected_token=None):
+        api.ACCESS_TOKEN = "fresh"
+    api = script(
+        ["endpoint_key", "circuit_is_open", "circuit_allows_request", "record_endpoint_success", "record_endpoint_failure", "backoff_seconds", "request_data_from_fitbit", "create_fitbit_subscriptions"],
+        requests=fake_requests, logging=logging, re=re, time=time, random=random, threading=threading, urlparse=urlparse, ConnectionError=ConnectionError, Timeout=Timeout,
+        circuit_breakers={}, circuit_breakers_lock=threading.Lock(), ACCESS_TOKEN="expired", Get_New_Access_Token=refresh, client_id="id", client_secret="secret",
+        REPLAY_FROM_RAW_ARCHIVE=False, RAW_RESPONSE_ARCHIVE_PATH="", FITBIT_LANGUAGE="en_US", REQUEST_TIMEOUT_SECONDS=5, REQUEST_DEADLINE_SECONDS=5,
+        EXPIRED_TOKEN_MAX_RETRY=5, SERVER_ERROR_MAX_RETRY=3, SKIP_REQUEST_ON_SERVER_ERROR=True, RETRY_BACKOFF_BASE_SECONDS=0, RETRY_BACKOFF_MAX_SECONDS=0,
+        CIRCUIT_BREAKER_THRESHOLD=5, CIRCUIT_BREAKER_COOLDOWN_SECONDS=60, FITBIT_SUBSCRIPTION_COLLECTIONS=["sleep"], FITBIT_SUBSCRIBER_ID="fitbit-fetch")
+    api.create_fitbit_subscriptions()
+    assert posts == ["Bearer expired", "Bearer fresh"]